@@ -0,0 +1,594 @@
+#! /usr/bin/env python
+import os
+import sys
+import json
+import math
+import random
+import timeit
+import argparse
+import tempfile
+import shutil
+import collections
+import multiprocessing
+
+# Run without opening a window
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("PYGAME_HIDE_SUPPORT_PROMPT", "1")
+
+import numpy as np
+import pygame
+
+import py_caster
+
+##############################################################
+# Benchmark parameters
+##############################################################
+
+WALL_COUNTS    = [10, 100, 1000, 10000]
+FRAMES         = 60
+PILLAR_SIZE    = 0.5
+PILLAR_SPACING = 2.0
+PLANE_LENGTH   = 0.66
+
+SWEEP_FB_SIZES      = [(160, 100), (320, 200), (640, 400)]
+SWEEP_WALL_COUNTS   = [100, 1000, 10000]
+SWEEP_SPRITE_COUNTS = [2, 20, 200]
+SWEEP_FIELD_SPRITES = [200, 2000, 20000] # Sprites scattered over a whole pillar field
+SWEEP_FIELD_WALLS   = 1000
+
+SWEEP_ROOMS       = [4, 8, 16, 32] # Rooms per side of the square maps of rooms
+ROOM_SIZE         = 4.0
+DOOR_WIDTH        = 1.0
+PILLARS_PER_ROOM  = 4
+SPRITES_PER_ROOM  = 4
+
+STARTUP_RUNS = 5 # Times every startup case is measured, the median is reported
+
+BATCH_FB_SIZES = [(80, 50), (160, 100)] # Small frame buffers like the ones fed to training pipelines
+BATCH_SIZE     = 256
+
+##############################################################
+# Scene generation
+##############################################################
+
+def pillar_walls(num_walls, texture, seed = 0):
+    # Square pillars of four walls each scattered over a jittered lattice, the map grows with the wall count
+    # while the density around the camera stays the same.
+    rng = random.Random(seed)
+    num_pillars = int(math.ceil(num_walls / 4.0))
+    side = int(math.ceil(math.sqrt(num_pillars)))
+    walls = []
+    for k in xrange(num_pillars):
+        cx = (k % side) * PILLAR_SPACING + rng.uniform(-0.5, 0.5)
+        cy = (k / side) * PILLAR_SPACING + rng.uniform(-0.5, 0.5)
+        corners = [py_caster.vec2(cx - PILLAR_SIZE / 2.0, cy - PILLAR_SIZE / 2.0),
+                   py_caster.vec2(cx + PILLAR_SIZE / 2.0, cy - PILLAR_SIZE / 2.0),
+                   py_caster.vec2(cx + PILLAR_SIZE / 2.0, cy + PILLAR_SIZE / 2.0),
+                   py_caster.vec2(cx - PILLAR_SIZE / 2.0, cy + PILLAR_SIZE / 2.0)]
+        for c in xrange(4):
+            walls.append(py_caster.LineSegment(corners[c], corners[(c + 1) % 4], 0.0, 1.0, texture))
+
+    # The camera stands between the pillars closest to the center of the field
+    center = ((side / 2) + 0.5) * PILLAR_SPACING
+    return walls[:num_walls], py_caster.vec2(center, center)
+
+def pillar_scene(num_walls, num_sprites = 0, seed = 0, sprite_radius = 3.0):
+    # The sprites are scattered around the camera, or over the whole field if sprite_radius is None
+    walls, center = pillar_walls(num_walls, "Textures/metal.jpg", seed)
+    rng = random.Random(seed)
+    radius = center.x if sprite_radius is None else sprite_radius
+    sprites = [py_caster.Sprite(py_caster.vec2(center.x + rng.uniform(-radius, radius), center.y + rng.uniform(-radius, radius)),
+                                "Textures/bag.png")
+               for k in xrange(num_sprites)]
+    return py_caster.Scene(walls, py_caster.Plane3d(py_caster.FLOOR_TEXTURE), py_caster.Plane3d(py_caster.CEIL_TEXTURE),
+                           py_caster.Sky(py_caster.SKY_TEXTURE), sprites), center
+
+def door_side(a, b, door, open_door, texture):
+    # Walls along the side of a room from a to b, with a doorway of DOOR_WIDTH around the fraction door of the side
+    half = DOOR_WIDTH / (2.0 * b.distance(a))
+    d0 = a.add(b.sub(a).scale(door - half))
+    d1 = a.add(b.sub(a).scale(door + half))
+    walls = [py_caster.LineSegment(a, d0, 0.0, 1.0, texture), py_caster.LineSegment(d1, b, 0.0, 1.0, texture)]
+    if not open_door:
+        walls.append(py_caster.LineSegment(d0, d1, 0.0, 1.0, texture))
+    return walls, [d0, d1]
+
+def rooms_scene(rooms, seed = 0, with_sectors = True):
+    # A square map of rooms with a doorway between neighbouring rooms and pillars and sprites inside every room.
+    # Every room is a sector whose edges are split around its doorways, the doorways being the portals.
+    # Returns the scene and the center of the middle room.
+    rng = random.Random(seed)
+    doors = {}
+    for i in xrange(rooms + 1):
+        for j in xrange(rooms):
+            # Doorways sit anywhere along the sides, away from the corners, so rooms don't line up
+            doors[("x", i, j)] = rng.uniform(0.3, 0.7)
+            doors[("y", j, i)] = rng.uniform(0.3, 0.7)
+
+    walls = []
+    points = {}
+    for i in xrange(rooms + 1):
+        for j in xrange(rooms):
+            # The vertical side at x = i and the horizontal one at y = i, closed at the edges of the map
+            outer = i == 0 or i == rooms
+            side, points[("x", i, j)] = door_side(py_caster.vec2(i * ROOM_SIZE, j * ROOM_SIZE),
+                                                  py_caster.vec2(i * ROOM_SIZE, (j + 1) * ROOM_SIZE),
+                                                  doors[("x", i, j)], not outer, "Textures/metal.jpg")
+            walls.extend(side)
+            side, points[("y", j, i)] = door_side(py_caster.vec2(j * ROOM_SIZE, i * ROOM_SIZE),
+                                                  py_caster.vec2((j + 1) * ROOM_SIZE, i * ROOM_SIZE),
+                                                  doors[("y", j, i)], not outer, "Textures/orangetiles.jpg")
+            walls.extend(side)
+
+    sectors = []
+    sprites = []
+    for i in xrange(rooms):
+        for j in xrange(rooms):
+            x0, y0, x1, y1 = i * ROOM_SIZE, j * ROOM_SIZE, (i + 1) * ROOM_SIZE, (j + 1) * ROOM_SIZE
+            bottom, right, top, left = points[("y", i, j)], points[("x", i + 1, j)], points[("y", i, j + 1)], points[("x", i, j)]
+            polygon = ([py_caster.vec2(x0, y0)] + bottom + [py_caster.vec2(x1, y0)] + right +
+                       [py_caster.vec2(x1, y1)] + top[::-1] + [py_caster.vec2(x0, y1)] + left[::-1])
+            sectors.append([(v.x, v.y) for v in polygon])
+
+            # Pillars and sprites away from the walls of the room, none at its center where the camera stands
+            for k in xrange(PILLARS_PER_ROOM):
+                cx = x0 + (ROOM_SIZE * (0.25 + (0.5 * (k % 2)))) + rng.uniform(-0.3, 0.3)
+                cy = y0 + (ROOM_SIZE * (0.25 + (0.5 * (k / 2 % 2)))) + rng.uniform(-0.3, 0.3)
+                corners = [py_caster.vec2(cx - PILLAR_SIZE / 4.0, cy - PILLAR_SIZE / 4.0),
+                           py_caster.vec2(cx + PILLAR_SIZE / 4.0, cy - PILLAR_SIZE / 4.0),
+                           py_caster.vec2(cx + PILLAR_SIZE / 4.0, cy + PILLAR_SIZE / 4.0),
+                           py_caster.vec2(cx - PILLAR_SIZE / 4.0, cy + PILLAR_SIZE / 4.0)]
+                for c in xrange(4):
+                    walls.append(py_caster.LineSegment(corners[c], corners[(c + 1) % 4], 0.0, 1.0, "Textures/diagmetal.jpg"))
+            for k in xrange(SPRITES_PER_ROOM):
+                position = py_caster.vec2(x0 + rng.uniform(0.5, ROOM_SIZE - 0.5), y0 + rng.uniform(0.5, ROOM_SIZE - 0.5))
+                sprites.append(py_caster.Sprite(position, "Textures/bag.png"))
+
+    center = ((rooms / 2) + 0.5) * ROOM_SIZE
+    scene = py_caster.Scene(walls, py_caster.Plane3d(py_caster.FLOOR_TEXTURE), py_caster.Plane3d(py_caster.CEIL_TEXTURE),
+                            py_caster.Sky(py_caster.SKY_TEXTURE), sprites, sectors if with_sectors else None)
+    return scene, py_caster.vec2(center, center)
+
+def add_sprites(scene, num_sprites, seed = 0):
+    # Scatters sprites over the open area in the middle of the sample level
+    rng = random.Random(seed)
+    scene.add_sprites([py_caster.Sprite(py_caster.vec2(rng.uniform(-2.5, 2.5), rng.uniform(-0.8, 1.8)), "Textures/bag.png")
+                       for k in xrange(num_sprites)])
+
+##############################################################
+# Camera paths
+##############################################################
+
+def pose(x, y, angle):
+    # Camera looking along angle with the same field of view as main()
+    player_dir = py_caster.vec2(math.cos(angle), math.sin(angle))
+    return py_caster.vec2(x, y), player_dir, py_caster.vec2(player_dir.y * PLANE_LENGTH, -player_dir.x * PLANE_LENGTH)
+
+def scripted_path(frames = FRAMES, center = py_caster.vec2(0.0, 0.5), radius = 1.0):
+    # Walks a circle around center while turning twice as fast, so every wall is seen from several places
+    poses = []
+    for f in xrange(frames):
+        t = 2.0 * math.pi * f / frames
+        poses.append(pose(center.x + (radius * math.cos(t)), center.y + (radius * math.sin(t)), math.pi + (2.0 * t)))
+    return poses
+
+def load_path(file_name):
+    # A recorded path is a JSON list of [pos_x, pos_y, dir_x, dir_y, plane_x, plane_y] poses
+    with open(file_name) as f:
+        return [(py_caster.vec2(p[0], p[1]), py_caster.vec2(p[2], p[3]), py_caster.vec2(p[4], p[5])) for p in json.load(f)]
+
+##############################################################
+# Benchmarks
+##############################################################
+
+def frame_stats(times):
+    times = np.array(times) * 1000.0
+    p50, p95, p99 = np.percentile(times, [50, 95, 99])
+    return {
+        "frames": len(times),
+        "mean_ms": float(times.mean()),
+        "p50_ms": float(p50),
+        "p95_ms": float(p95),
+        "p99_ms": float(p99)
+    }
+
+def run_path(scene, poses, fb_size = py_caster.FB_SIZE, sky_enabled = False, screen = None, profile = False, workers = 0,
+             target_fps = None, record = None, record_drop = py_caster.RECORD_DROP_FRAMES):
+    # Renders every pose as fast as possible and returns the frame time statistics.
+    # Frames reused because the pose did not change are only counted in reused_frames, not timed.
+    # With a target FPS the frame buffer size is adapted to it like main() does with DYNAMIC_RESOLUTION.
+    # With a record format the frames are also recorded to a temporary directory that is removed afterwards.
+    renderer = py_caster.ParallelRenderer(scene, fb_size, workers) if workers > 0 else py_caster.Renderer(fb_size)
+    renderer.profiler.enabled = profile
+    renderer.profiler.window = len(poses)
+    scaler = py_caster.ResolutionScaler(fb_size, target_fps) if target_fps is not None else None
+    record_dir = tempfile.mkdtemp() if record is not None else None
+    recorder = py_caster.FrameRecorder(record_dir, fb_size, record, drop = record_drop) if record is not None else None
+    sizes = collections.Counter()
+    times = []
+    for player_pos, player_dir, plane in poses:
+        start = timeit.default_timer()
+        rendered = renderer.render(scene, player_pos, player_dir, plane, sky_enabled)
+        if recorder is not None:
+            renderer.profiler.start("record")
+            recorder.record(renderer.frame_buffer)
+            renderer.profiler.stop("record")
+        if screen is not None:
+            renderer.profiler.start("present")
+            renderer.present(screen)
+            pygame.display.update()
+            renderer.profiler.stop("present")
+        renderer.profiler.end_frame()
+        sizes["%dx%d" % renderer.size] += 1
+        if not rendered:
+            continue
+        times.append(timeit.default_timer() - start)
+        if scaler is not None:
+            renderer.resize(scaler.update(times[-1]))
+
+    if workers > 0:
+        renderer.close()
+    if recorder is not None:
+        start = timeit.default_timer()
+        recording = recorder.close()
+        recording["flush_ms"] = (timeit.default_timer() - start) * 1000.0
+        del recording["directory"]
+        shutil.rmtree(record_dir)
+
+    result = frame_stats(times)
+    result["fb_size"] = list(fb_size)
+    result["walls"] = scene.caster.num_walls()
+    result["sprites"] = len(scene.sprites)
+    result["sky"] = sky_enabled
+    result["workers"] = workers
+    result["column_cache"] = renderer.column_cache.stats()
+    result["reused_frames"] = renderer.tracker.reused
+    if scaler is not None:
+        result["target_fps"] = target_fps
+        result["resolutions"] = dict(sizes)
+        result["resolution_changes"] = scaler.changes
+    if profile:
+        result["profile"] = renderer.profiler.stats()
+    if recorder is not None:
+        result["recording"] = recording
+    return result
+
+def sweep(frames = FRAMES, screen = None):
+    # Varies one parameter at a time around the sample level at FB_SIZE
+    results = []
+    poses = scripted_path(frames)
+
+    for fb_size in SWEEP_FB_SIZES:
+        row = run_path(py_caster.sample_scene(), poses, fb_size, screen = screen)
+        row["sweep"] = "fb_size"
+        results.append(row)
+
+    for count in SWEEP_WALL_COUNTS:
+        scene, center = pillar_scene(count)
+        row = run_path(scene, [pose(center.x, center.y, 2.0 * math.pi * f / frames) for f in xrange(frames)], screen = screen)
+        row["sweep"] = "walls"
+        results.append(row)
+
+    for count in SWEEP_SPRITE_COUNTS:
+        scene = py_caster.sample_scene()
+        add_sprites(scene, count - len(scene.sprites))
+        row = run_path(scene, poses, screen = screen)
+        row["sweep"] = "sprites"
+        results.append(row)
+
+    for count in SWEEP_FIELD_SPRITES:
+        scene, center = pillar_scene(SWEEP_FIELD_WALLS, count, sprite_radius = None)
+        row = run_path(scene, [pose(center.x, center.y, 2.0 * math.pi * f / frames) for f in xrange(frames)], screen = screen)
+        row["sweep"] = "field"
+        results.append(row)
+
+    return results
+
+def scaling(max_workers, frames = FRAMES, screen = None):
+    # Renders the sample level in the main process and then with 1 to max_workers worker processes
+    results = []
+    poses = scripted_path(frames)
+    serial = None
+    for workers in xrange(max_workers + 1):
+        row = run_path(py_caster.sample_scene(), poses, screen = screen, workers = workers)
+        serial = row["mean_ms"] if serial is None else serial
+        row["speedup"] = serial / row["mean_ms"]
+        results.append(row)
+    return results
+
+def startup(runs = STARTUP_RUNS):
+    # Time to first frame of the sample level: loading it and rendering its first frame, without and with the
+    # texture cache and with eager, lazy and prefetched textures. The level cache is already compiled.
+    # The first run of the cold case decodes every texture into an empty cache, later runs reuse it.
+    cases = [
+        ("no cache", False, False, False),
+        ("cold cache", True, False, False),
+        ("warm cache", True, False, False),
+        ("lazy", True, True, False),
+        ("prefetch", True, True, True)
+    ]
+    py_caster.load_level(py_caster.LEVEL_FILE)
+    cache_dir = tempfile.mkdtemp()
+    saved = py_caster.TEXTURE_CACHE, py_caster.TEXTURE_CACHE_DIR, py_caster.LAZY_TEXTURES
+    results = []
+    thread = None
+    try:
+        for name, cache, lazy, prefetch in cases:
+            rows = []
+            for run in xrange(runs):
+                if name == "cold cache":
+                    shutil.rmtree(cache_dir)
+                py_caster.TEXTURE_CACHE, py_caster.TEXTURE_CACHE_DIR, py_caster.LAZY_TEXTURES = cache, cache_dir, lazy
+                py_caster.TEXTURES.clear()
+
+                start = timeit.default_timer()
+                scene, (player_pos, player_dir, plane) = py_caster.load_level(py_caster.LEVEL_FILE)
+                loaded = timeit.default_timer()
+                renderer = py_caster.Renderer(py_caster.FB_SIZE)
+                if prefetch:
+                    thread = py_caster.TEXTURES.prefetch(scene.textures_near(player_pos,
+                                                                             py_caster.TEXTURE_PREFETCH_RADIUS))
+                renderer.render(scene, player_pos, player_dir, plane)
+                end = timeit.default_timer()
+                # The prefetch must not keep decoding into the next run
+                if thread is not None:
+                    thread.join()
+                    thread = None
+                rows.append(((loaded - start) * 1000.0, (end - loaded) * 1000.0, (end - start) * 1000.0,
+                             py_caster.TEXTURES.loaded()))
+
+            load_ms, frame_ms, total_ms, textures = np.median(np.array(rows), axis = 0).tolist()
+            results.append({"case": name, "load_ms": load_ms, "first_frame_ms": frame_ms, "total_ms": total_ms,
+                            "textures_loaded": int(textures), "textures": len(py_caster.TEXTURES.textures)})
+    finally:
+        if thread is not None:
+            thread.join()
+        py_caster.TEXTURE_CACHE, py_caster.TEXTURE_CACHE_DIR, py_caster.LAZY_TEXTURES = saved
+        py_caster.TEXTURES.clear()
+        shutil.rmtree(cache_dir, ignore_errors = True)
+    return results
+
+def bench_sectors(room_counts = SWEEP_ROOMS, frames = FRAMES, screen = None):
+    # Turns around in the middle room of growing maps of rooms, with and without sectors
+    results = []
+    for rooms in room_counts:
+        for with_sectors in (False, True):
+            scene, center = rooms_scene(rooms, with_sectors = with_sectors)
+            row = run_path(scene, [pose(center.x, center.y, 2.0 * math.pi * f / frames) for f in xrange(frames)],
+                           screen = screen, profile = True)
+            row["rooms"] = rooms * rooms
+            row["sectors"] = with_sectors
+            results.append(row)
+    return results
+
+def bench_casters(wall_counts = WALL_COUNTS, frames = FRAMES):
+    # Time one full turn of the camera with the brute force caster and with the grid for each wall count
+    camera_x = 2.0 * (np.arange(py_caster.FB_SIZE[0]) / float(py_caster.FB_SIZE[0])) - 1
+    results = []
+
+    for count in wall_counts:
+        walls, player_pos = pillar_walls(count, "Textures/metal.jpg")
+        row = {"walls": len(walls)}
+
+        for name, caster_class in (("brute", py_caster.WallCaster), ("grid", py_caster.WallGrid)):
+            start = timeit.default_timer()
+            caster = caster_class(walls)
+            row[name + "_build_ms"] = (timeit.default_timer() - start) * 1000.0
+
+            start = timeit.default_timer()
+            for f in xrange(frames):
+                player_pos, player_dir, plane = pose(player_pos.x, player_pos.y, 2.0 * math.pi * f / frames)
+                ray_dirs = np.empty((py_caster.FB_SIZE[0], 2))
+                ray_dirs[:, 0] = player_dir.x + (plane.x * camera_x)
+                ray_dirs[:, 1] = player_dir.y + (plane.y * camera_x)
+                caster.cast(player_pos, ray_dirs)
+            row[name + "_frame_ms"] = (timeit.default_timer() - start) * 1000.0 / frames
+
+        results.append(row)
+
+    return results
+
+def count_allocations(function, classes):
+    # Runs function counting the instances of the given classes it creates by hooking their constructors
+    names = dict((c.__init__.im_func.func_code, c.__name__) for c in classes)
+    counts = dict((c.__name__, 0) for c in classes)
+
+    def hook(frame, event, arg):
+        if event == "call" and frame.f_code in names:
+            counts[names[frame.f_code]] += 1
+
+    sys.setprofile(hook)
+    try:
+        function()
+    finally:
+        sys.setprofile(None)
+    return counts
+
+def allocations(frames = FRAMES):
+    # Counts the vectors, rays and intersections created per frame along the scripted path, both for full frames and
+    # for the scalar LineSegment path the parity check runs, and times them without the counting hook
+    scene = py_caster.sample_scene()
+    poses = scripted_path(frames)
+    renderer = py_caster.Renderer(py_caster.FB_SIZE)
+    camera_x = 2.0 * (np.arange(py_caster.FB_SIZE[0]) / float(py_caster.FB_SIZE[0])) - 1
+
+    def parity():
+        for player_pos, player_dir, plane in poses:
+            ray_dirs = np.empty((py_caster.FB_SIZE[0], 2))
+            ray_dirs[:, 0] = player_dir.x + (plane.x * camera_x)
+            ray_dirs[:, 1] = player_dir.y + (plane.y * camera_x)
+            scene.caster.check_parity(player_pos, ray_dirs)
+
+    def render():
+        for player_pos, player_dir, plane in poses:
+            renderer.render(scene, player_pos, player_dir, plane)
+
+    results = {}
+    for name, function in (("render", render), ("parity", parity)):
+        counts = count_allocations(function, (py_caster.vec2, py_caster.vec3, py_caster.Ray, py_caster.Intersection))
+        start = timeit.default_timer()
+        function()
+        results[name] = {
+            "ms_per_frame": (timeit.default_timer() - start) * 1000.0 / frames,
+            "objects_per_frame": dict((k, float(v) / frames) for k, v in counts.iteritems())
+        }
+    return results
+
+def batch(max_workers = 0, frames = FRAMES):
+    # Frames per second of render_batch over the scripted path repeated up to BATCH_SIZE poses, against rendering the
+    # same poses one at a time and against a BatchRenderer with 1 to max_workers processes
+    scene = py_caster.sample_scene()
+    path = py_caster.pose_array(scripted_path(frames))
+    poses = np.tile(path, ((BATCH_SIZE + len(path) - 1) / len(path), 1))[:BATCH_SIZE]
+    results = []
+    for fb_size in BATCH_FB_SIZES:
+        renderer = py_caster.Renderer(fb_size)
+        start = timeit.default_timer()
+        for p in poses.tolist():
+            player_pos, player_dir, plane = py_caster.vec2(p[0], p[1]), py_caster.vec2(p[2], p[3]), py_caster.vec2(p[4], p[5])
+            renderer.frame_buffer.fill(py_caster.FILL_COLOR)
+            renderer.render_world(scene, player_pos, player_dir, plane)
+            renderer.render_sprites(scene, player_pos, player_dir, plane)
+        single = len(poses) / (timeit.default_timer() - start)
+
+        for workers in range(max_workers + 1):
+            batch_renderer = py_caster.BatchRenderer(scene, fb_size, workers)
+            start = timeit.default_timer()
+            batch_renderer.render(poses)
+            fps = len(poses) / (timeit.default_timer() - start)
+            batch_renderer.close()
+            results.append({"fb_size": fb_size, "workers": workers, "poses": len(poses), "single_fps": single,
+                            "batch_fps": fps, "speedup": fps / single})
+    return results
+
+##############################################################
+# Main Function
+##############################################################
+
+def main():
+    parser = argparse.ArgumentParser(description = "Headless benchmark of the Py Caster renderer.")
+    parser.add_argument("--frames", type = int, default = FRAMES, help = "frames of the scripted path")
+    parser.add_argument("--path", help = "JSON file with a recorded camera path to replay")
+    parser.add_argument("--sky", action = "store_true", help = "render with the sky enabled")
+    parser.add_argument("--profile", action = "store_true", help = "time every stage of the replayed path")
+    parser.add_argument("--sweep", action = "store_true", help = "sweep frame buffer sizes, wall counts and sprite counts")
+    parser.add_argument("--scaling", type = int, nargs = "?", const = multiprocessing.cpu_count(), metavar = "N",
+                        help = "compare rendering in the main process against 1 to N worker processes")
+    parser.add_argument("--target-fps", type = int, help = "adapt the frame buffer size of the replayed path to this FPS")
+    parser.add_argument("--record", choices = ["png", "raw"], help = "record the replayed path in this format")
+    parser.add_argument("--record-wait", action = "store_true",
+                        help = "wait for the recording writer instead of dropping frames when its queue is full")
+    parser.add_argument("--workers", type = int, default = 0, help = "worker processes rendering the replayed path")
+    parser.add_argument("--startup", action = "store_true",
+                        help = "time loading the sample level and rendering its first frame with and without the texture cache")
+    parser.add_argument("--sectors", action = "store_true", help = "compare maps of rooms with and without sectors")
+    parser.add_argument("--casters", action = "store_true", help = "compare the brute force caster against the grid")
+    parser.add_argument("--allocations", action = "store_true",
+                        help = "count the vectors created per frame by the renderer and the parity check")
+    parser.add_argument("--batch", type = int, nargs = "?", const = 0, metavar = "N",
+                        help = "time headless batch rendering of small frames in the main process and 1 to N workers")
+    parser.add_argument("--output", help = "write the results as JSON to this file, - for stdout")
+    args = parser.parse_args()
+
+    pygame.init()
+    screen = pygame.display.set_mode(py_caster.SCREEN_SIZE)
+
+    poses = load_path(args.path) if args.path is not None else scripted_path(args.frames)
+    # Startup is measured first, before the path loads every texture
+    startup_results = startup() if args.startup else None
+    results = {"path": run_path(py_caster.sample_scene(), poses, sky_enabled = args.sky, screen = screen,
+                                 profile = args.profile, workers = args.workers, target_fps = args.target_fps,
+                                 record = args.record, record_drop = not args.record_wait)}
+    if args.sweep:
+        results["sweep"] = sweep(args.frames, screen)
+    if args.scaling is not None:
+        results["scaling"] = scaling(args.scaling, args.frames, screen)
+    if startup_results is not None:
+        results["startup"] = startup_results
+    if args.sectors:
+        results["sectors"] = bench_sectors(frames = args.frames, screen = screen)
+    if args.casters:
+        results["casters"] = bench_casters(frames = args.frames)
+    if args.allocations:
+        results["allocations"] = allocations(args.frames)
+    if args.batch is not None:
+        results["batch"] = batch(args.batch, args.frames)
+
+    pygame.quit()
+
+    if args.output == "-":
+        json.dump(results, sys.stdout, indent = 2, sort_keys = True)
+        print
+        return
+    elif args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent = 2, sort_keys = True)
+
+    rows = [results["path"]] + results.get("sweep", [])
+    print "%-8s %10s %6s %8s %9s %9s %9s %9s" % ("sweep", "fb_size", "walls", "sprites", "mean ms", "p50 ms", "p95 ms", "p99 ms")
+    for row in rows:
+        print "%-8s %10s %6d %8d %9.3f %9.3f %9.3f %9.3f" % (row.get("sweep", "path"), "%dx%d" % tuple(row["fb_size"]),
+                                                            row["walls"], row["sprites"], row["mean_ms"],
+                                                            row["p50_ms"], row["p95_ms"], row["p99_ms"])
+
+    if args.target_fps is not None:
+        print
+        print "%d resolution changes, frames per size: %s" % (results["path"]["resolution_changes"],
+                                                             ", ".join("%s %d" % r for r in sorted(results["path"]["resolutions"].items())))
+
+    if args.record is not None:
+        print
+        print "%(written)d of %(recorded)d frames recorded as %(format)s, %(dropped)d dropped, " \
+              "%(flush_ms).1f ms to flush the queue" % results["path"]["recording"]
+
+    if args.profile:
+        print
+        for stage, st in results["path"]["profile"]["stages"].iteritems():
+            print "%-14s %9.3f ms" % (stage, st["mean_ms"])
+        for counter, st in results["path"]["profile"]["counters"].iteritems():
+            print "%-14s %9.0f" % (counter, st["mean"])
+
+    if args.scaling is not None:
+        print
+        print "%8s %9s %9s %8s" % ("workers", "mean ms", "p95 ms", "speedup")
+        for row in results["scaling"]:
+            print "%8d %9.3f %9.3f %8.2f" % (row["workers"], row["mean_ms"], row["p95_ms"], row["speedup"])
+
+    if args.startup:
+        print
+        print "%-12s %9s %14s %9s %9s" % ("startup", "load ms", "first frame ms", "total ms", "textures")
+        for row in results["startup"]:
+            print "%-12s %9.2f %14.2f %9.2f %5d/%-3d" % (row["case"], row["load_ms"], row["first_frame_ms"], row["total_ms"],
+                                                        row["textures_loaded"], row["textures"])
+
+    if args.sectors:
+        print
+        print "%6s %6s %8s %9s %9s %14s" % ("rooms", "walls", "sectors", "mean ms", "p95 ms", "intersections")
+        for row in results["sectors"]:
+            print "%6d %6d %8s %9.3f %9.3f %14.0f" % (row["rooms"], row["walls"], "yes" if row["sectors"] else "no", row["mean_ms"],
+                                                     row["p95_ms"], row["profile"]["counters"]["intersections"]["mean"])
+
+    if args.casters:
+        print
+        print "%8s %14s %14s %14s %14s" % ("walls", "brute ms/frame", "grid ms/frame", "brute build ms", "grid build ms")
+        for row in results["casters"]:
+            print "%8d %14.3f %14.3f %14.3f %14.3f" % (row["walls"], row["brute_frame_ms"], row["grid_frame_ms"],
+                                                      row["brute_build_ms"], row["grid_build_ms"])
+
+    if args.allocations:
+        print
+        print "%-8s %9s %12s %12s %12s %12s" % ("frame", "ms/frame", "vec2", "vec3", "Ray", "Intersection")
+        for name, row in sorted(results["allocations"].iteritems()):
+            counts = row["objects_per_frame"]
+            print "%-8s %9.3f %12.1f %12.1f %12.1f %12.1f" % (name, row["ms_per_frame"], counts["vec2"], counts["vec3"],
+                                                             counts["Ray"], counts["Intersection"])
+
+    if args.batch is not None:
+        print
+        print "%10s %8s %6s %11s %11s %8s" % ("fb_size", "workers", "poses", "single fps", "batch fps", "speedup")
+        for row in results["batch"]:
+            print "%10s %8d %6d %11.1f %11.1f %8.2f" % ("%dx%d" % tuple(row["fb_size"]), row["workers"], row["poses"],
+                                                       row["single_fps"], row["batch_fps"], row["speedup"])
+
+if __name__ == "__main__":
+    main()
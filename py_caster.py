@@ -1,5 +1,20 @@
 #! /usr/bin/env python
+import os
+import errno
 import math
+import json
+import mmap
+import struct
+import hashlib
+import ctypes
+import multiprocessing
+import multiprocessing.sharedctypes
+import timeit
+import zlib
+import threading
+import Queue
+import collections
+import numpy as np
 import pygame
 
 ##############################################################
@@ -15,6 +30,10 @@ TOLERANCE     = 0.000001
 FLOOR_TEXTURE = "Textures/goldlites.jpg"
 CEIL_TEXTURE  = "Textures/brownstone.jpg"
 SKY_TEXTURE   = "Textures/starynight.png"
+LEVEL_FILE    = "Levels/sample.lvl"
+PARITY_CHECK  = False # Check the wall caster against LineSegment.intersect every frame
+RENDER_WORKERS = 0    # Processes rendering strips of columns in parallel, 0 renders everything in the main process
+BATCH_CHUNK    = 64   # Most poses a render worker gets at once from a BatchRenderer
 
 ##############################################################
 # Projection parameters
@@ -23,9 +42,80 @@ SKY_TEXTURE   = "Textures/starynight.png"
 FB_SIZE                = (320, 200)
 DEG2RAD                = 3.1415926535897932384626433 / 180.0
 RAD2DEG                = 180.0 / 3.1415926535897932384626433
-FOV                    = 0.0
-ANGLE_INCREMENT        = 0.0
 HEIGHT_CLAMP_MULTIPLER = 10 # MUST BE AN INTEGER
+MIPMAPPING             = True # Sample distant walls from smaller versions of their textures
+PROJECTION_FOV_TOLERANCE = 0.000001 # Degrees the field of view must change by to rebuild the projection tables
+
+##############################################################
+# Level cache parameters
+##############################################################
+
+LEVEL_CACHE_SUFFIX  = ".cache"   # Compiled levels are stored next to their source with this suffix
+LEVEL_CACHE_MAGIC   = "PYCASTLV"
+LEVEL_CACHE_VERSION = 2
+
+##############################################################
+# Wall grid parameters
+##############################################################
+
+GRID_WALLS_PER_CELL = 2.0 # Average number of walls per cell the grid is sized for
+GRID_MAX_CELLS      = 256 # Maximum number of cells along each axis
+
+##############################################################
+# Sector parameters
+##############################################################
+
+SECTOR_TOLERANCE = 0.000001 # Distance within which points are inside a sector and walls touch it
+SECTOR_MAX_DEPTH = 256      # Most portals the visibility pass walks through along one path
+SECTOR_MAX_WALLS = 512      # Visible sets with more walls than this are cast with the caster over every wall
+
+##############################################################
+# Texture cache parameters
+##############################################################
+
+TEXTURE_CACHE           = True              # Keep decoded textures as raw pixels to skip decoding them next time
+TEXTURE_CACHE_DIR       = ".texture_cache"
+TEXTURE_CACHE_SUFFIX    = ".tex"
+TEXTURE_CACHE_MAGIC     = "PYCASTTX"
+TEXTURE_CACHE_VERSION   = 1
+LAZY_TEXTURES           = True              # Load the pixels of a texture the first time they are used
+TEXTURE_PREFETCH_RADIUS = 6.0               # Textures used this close to the spawn are loaded in the background
+
+##############################################################
+# Column cache parameters
+##############################################################
+
+COLUMN_CACHE_SIZE     = 32 * 1024 * 1024 # Maximum number of bytes of scaled columns kept in memory
+COLUMN_CACHE_PRESHADE = True             # Store wall columns already darkened by distance
+
+##############################################################
+# Dynamic resolution parameters
+##############################################################
+
+DYNAMIC_RESOLUTION   = False # Scale the frame buffer down and up to hold the FPS target
+RESOLUTION_SCALES    = [0.5, 0.625, 0.75, 0.875, 1.0] # Steps of the frame buffer size relative to FB_SIZE
+RESOLUTION_WINDOW    = 15   # Frames averaged before changing the size
+RESOLUTION_DOWN_LOAD = 0.95 # Step down when the frames take more than this fraction of the frame budget
+RESOLUTION_UP_LOAD   = 0.8  # Step up when the next step is expected to take less than this fraction
+
+##############################################################
+# Recording parameters
+##############################################################
+
+RECORDING          = False      # Record from the start, R starts and stops recording while playing
+RECORD_DIR         = "Captures" # Every recording goes to a new numbered directory inside this one
+RECORD_FORMAT      = "png"      # "png" for a PNG sequence, "raw" for a single file of raw RGB frames
+RECORD_QUEUE_SIZE  = 30         # Frames waiting to be written before the queue is full
+RECORD_DROP_FRAMES = True       # Drop frames while the queue is full instead of waiting for the writer
+RECORD_PNG_LEVEL   = 1          # zlib compression level of the PNG frames
+RECORD_POLL_TIME   = 0.1        # Seconds between checks that the writer is still running while waiting for it
+
+##############################################################
+# Profiler parameters
+##############################################################
+
+PROFILER_WINDOW = 60             # Number of frames the rolling statistics cover
+PROFILER_FILE   = "profile.json" # File the statistics are dumped to
 
 ##############################################################
 # Player parameters
@@ -38,9 +128,10 @@ PLAYER_MOVE_SPEED = 0.1
 # Vector Classes
 ##############################################################
 
+# The vectors use slots to avoid a dictionary per instance. add, sub, scale, normalize and mix return new vectors,
+# their counterparts starting with i modify the vector in place and return it.
 class vec(object):
-    def __ini__(self):
-        pass
+    __slots__ = ()
 
     def length(self):
         return math.sqrt(self.dot(self))
@@ -49,12 +140,20 @@ class vec(object):
         return self.dot(self)
     
     def distance(self, p):
-        return p.sub(self).length()
+        return math.sqrt(self.distanceSQ(p))
 
-    def distanceSQ(self, p):
-        return p.sub(self).lengthSQ()
+    def __iadd__(self, v):
+        return self.iadd(v)
+
+    def __isub__(self, v):
+        return self.isub(v)
+
+    def __imul__(self, k):
+        return self.iscale(k)
 
 class vec3(vec):
+    __slots__ = ("x", "y", "z")
+
     def __init__(self, x = 0, y = 0, z = 0):
         self.x = x
         self.y = y
@@ -74,8 +173,44 @@ class vec3(vec):
         
     def dot(self, v):
         return (self.x * v.x) + (self.y * v.y) + (self.z * v.z)
+
+    def distanceSQ(self, p):
+        x = p.x - self.x
+        y = p.y - self.y
+        z = p.z - self.z
+        return (x * x) + (y * y) + (z * z)
     
     def normalize(self):
+        return vec3(self.x, self.y, self.z).inormalize()
+
+    def mix(self, v, t):
+        return vec3((self.x * t) + (v.x * (1.0 - t)), (self.y * t) + (v.y * (1.0 - t)), (self.z * t) + (v.z * (1.0 - t)))
+
+    def set(self, x, y, z):
+        self.x = x
+        self.y = y
+        self.z = z
+        return self
+
+    def iadd(self, v):
+        self.x += v.x
+        self.y += v.y
+        self.z += v.z
+        return self
+
+    def isub(self, v):
+        self.x -= v.x
+        self.y -= v.y
+        self.z -= v.z
+        return self
+
+    def iscale(self, k):
+        self.x *= k
+        self.y *= k
+        self.z *= k
+        return self
+
+    def inormalize(self):
         norm = self.length()
         if norm > 0:
             self.x /= norm
@@ -83,10 +218,9 @@ class vec3(vec):
             self.z /= norm
         return self
 
-    def mix(self, v, t):
-        return vec3((self.x * t) + (v.x * (1.0 - t)), (self.y * t) + (v.y * (1.0 - t)), (self.z * t) + (v.z * (1.0 - t)))
-
 class vec2(vec):
+    __slots__ = ("x", "y")
+
     def __init__(self, x = 0, y = 0):
         self.x = x
         self.y = y
@@ -106,24 +240,134 @@ class vec2(vec):
     def dot(self, v):
         return (self.x * v.x) + (self.y * v.y)
 
+    def distanceSQ(self, p):
+        x = p.x - self.x
+        y = p.y - self.y
+        return (x * x) + (y * y)
+
     def normalize(self):
+        return vec2(self.x, self.y).inormalize()
+
+    def cross(self, v):
+        return vec3(0.0, 0.0, (self.x * v.y) - (self.y * v.x))
+
+    def mix(self, v, t):
+        return vec2((self.x * t) + (v.x * (1.0 - t)), (self.y * t) + (v.y * (1.0 - t)))
+
+    def set(self, x, y):
+        self.x = x
+        self.y = y
+        return self
+
+    def iadd(self, v):
+        self.x += v.x
+        self.y += v.y
+        return self
+
+    def iadd_scaled(self, v, k):
+        # Adds v scaled by k without creating the scaled vector
+        self.x += v.x * k
+        self.y += v.y * k
+        return self
+
+    def isub(self, v):
+        self.x -= v.x
+        self.y -= v.y
+        return self
+
+    def iscale(self, k):
+        self.x *= k
+        self.y *= k
+        return self
+
+    def inormalize(self):
         norm = self.length()
         if norm > 0:
             self.x /= norm
             self.y /= norm
         return self
 
+    def irotate(self, cos_a, sin_a):
+        # Applies a rotation matrix given the cosine and sine of the angle
+        x = self.x
+        self.x = x * cos_a - self.y * sin_a
+        self.y = x * sin_a + self.y * cos_a
+        return self
+
+class vec2_array(object):
+    # A set of 2D vectors stored as one array per component. It mirrors vec2, the other operand can be a vec2 or
+    # another vec2_array of the same length.
+    __slots__ = ("x", "y")
+
+    def __init__(self, x, y):
+        self.x = np.asarray(x, dtype = np.float64)
+        self.y = np.asarray(y, dtype = np.float64)
+
+    @classmethod
+    def from_array(cls, a):
+        # The components are views of the columns of an (n, 2) array
+        return cls(a[:, 0], a[:, 1])
+
+    def __len__(self):
+        return len(self.x)
+
+    def add(self, v):
+        return vec2_array(self.x + v.x, self.y + v.y)
+
+    def sub(self, v):
+        return vec2_array(self.x - v.x, self.y - v.y)
+
+    def scale(self, k):
+        return vec2_array(self.x * k, self.y * k)
+
+    def dot(self, v):
+        return (self.x * v.x) + (self.y * v.y)
+
     def cross(self, v):
-        return vec3(0.0, 0.0, (self.x * v.y) - (self.y * v.x))
+        return (self.x * v.y) - (self.y * v.x)
 
-    def mix(self, v, t):
-        return vec2((self.x * t) + (v.x * (1.0 - t)), (self.y * t) + (v.y * (1.0 - t)))
+    def length(self):
+        return np.sqrt(self.dot(self))
+
+    def lengthSQ(self):
+        return self.dot(self)
+
+    def normalize(self):
+        return vec2_array(self.x.copy(), self.y.copy()).inormalize()
+
+    def iadd(self, v):
+        self.x += v.x
+        self.y += v.y
+        return self
+
+    def isub(self, v):
+        self.x -= v.x
+        self.y -= v.y
+        return self
+
+    def iscale(self, k):
+        self.x *= k
+        self.y *= k
+        return self
+
+    def inormalize(self):
+        norm = self.length()
+        norm[norm == 0.0] = 1.0
+        self.x /= norm
+        self.y /= norm
+        return self
+
+    __iadd__ = iadd
+    __isub__ = isub
+    __imul__ = iscale
 
 ##############################################################
 # Ray Class
 ##############################################################
 
 class Ray(object):
+    __slots__ = ("o", "d")
+
     def __init__(self, origin = vec2(0.0, 0.0), direction = vec2(0.0, 1.0)):
         self.o = origin
         self.d = direction.normalize()
@@ -136,11 +380,307 @@ class Ray(object):
 ##############################################################
 
 class Intersection(object):
+    __slots__ = ("p", "d", "tc")
+
     def __init__(self, r, t, tex_coord = None):
-        self.p = r.o.add(r.d.scale(t))
+        self.p = vec2(r.o.x + (r.d.x * t), r.o.y + (r.d.y * t))
         self.d = r.o.distance(self.p)
         self.tc = tex_coord
 
+##############################################################
+# Texture classes
+##############################################################
+
+class Texture(object):
+    def __init__(self, surface, levels = None):
+        # levels is the mipmap chain starting with surface, built from it when not given
+        self.loader = None
+        self.set_levels([surface] if levels is None else levels)
+
+    @classmethod
+    def deferred(cls, loader):
+        # A texture whose mipmap chain is returned by loader the first time its pixels are needed
+        texture = cls.__new__(cls)
+        texture.loader = loader
+        texture.lock = threading.Lock()
+        return texture
+
+    def __getattr__(self, name):
+        # Only called for attributes that aren't set, which for a deferred texture means it isn't loaded yet
+        if name.startswith("__") or self.__dict__.get("loader") is None:
+            raise AttributeError(name)
+        self.load()
+        return object.__getattribute__(self, name)
+
+    def load(self):
+        # Loads a deferred texture, waiting for another thread already loading it
+        if self.loader is None:
+            return
+        with self.lock:
+            if self.loader is not None:
+                self.set_levels(self.loader())
+                self.loader = None
+
+    def set_levels(self, levels):
+        surface = levels[0]
+        self.surface = surface
+        self.width = surface.get_width()
+        self.height = surface.get_height()
+
+        # Column-major pixel array, self.pixels[x] is the texture column x
+        self.pixels = np.ascontiguousarray(pygame.surfarray.array3d(surface))
+
+        self.levels = mipmap_chain(levels)
+
+        # Precomputed one pixel wide column strips of every level, subsurfaces share the pixels of their level
+        self.columns = [[level.subsurface(pygame.Rect(x, 0, 1, level.get_height())) for x in xrange(level.get_width())]
+                        for level in self.levels]
+
+    def get_level(self, h):
+        # Returns the smallest mipmap level that is still at least h pixels tall
+        level = 0
+        while level + 1 < len(self.levels) and self.levels[level + 1].get_height() >= h:
+            level += 1
+        return level
+
+    def get_column(self, x, h = None):
+        # Returns the column x of the texture, taken from the mipmap level that best fits a height of h pixels
+        if h is None or not MIPMAPPING:
+            return self.columns[0][x]
+        level = self.get_level(h)
+        return self.columns[level][(x * self.levels[level].get_width()) / self.width]
+
+    def sample_column(self, s, h = None):
+        # Returns the column at the texture coordinate s, wrapping around the texture
+        w = self.width
+        _s = s * w if s >= 0.0 else (1.0 - (math.ceil(s) - s)) * w
+        _s = int(_s % w)
+        # The column strips are precomputed, no subsurface needs to be created
+        return self.get_column(_s, h)
+
+def mipmap_chain(levels):
+    # Completes a mipmap chain, each level is half the size of the previous one down to a single texel
+    levels = list(levels)
+    while levels[-1].get_width() > 1 or levels[-1].get_height() > 1:
+        w = max(levels[-1].get_width() / 2, 1)
+        h = max(levels[-1].get_height() / 2, 1)
+        levels.append(pygame.transform.smoothscale(levels[-1], (w, h)))
+    return levels
+
+def texture_format(alpha):
+    # Textures are converted to the pixel format of the display, or to the one convert_alpha picks for it
+    display = pygame.display.get_surface()
+    return "%d-%08x-%08x-%08x-%08x-%s" % ((display.get_bitsize(),) + tuple(display.get_masks()) +
+                                          ("alpha" if alpha else "opaque",))
+
+def texture_cache_name(file_name, alpha):
+    # Cached textures are named after the hash of their source file and their pixel format
+    with open(file_name, "rb") as f:
+        source_hash = hashlib.sha1(f.read()).hexdigest()
+    return os.path.join(TEXTURE_CACHE_DIR, "%s-%s%s" % (source_hash, texture_format(alpha), TEXTURE_CACHE_SUFFIX))
+
+def decode_texture(file_name, alpha):
+    # Returns the whole mipmap chain of a texture file converted to the display format
+    image = pygame.image.load(file_name)
+    return mipmap_chain([image.convert_alpha() if alpha else image.convert()])
+
+def save_texture_cache(cache_name, levels):
+    # Writes the raw pixels of every mipmap level after a JSON header with their sizes and formats, laid out
+    # like a compiled level
+    header = {"version": TEXTURE_CACHE_VERSION, "levels": []}
+    offset = 0
+    for level in levels:
+        header["levels"].append([level.get_width(), level.get_height(), level.get_bitsize(), list(level.get_masks()),
+                                 level.get_flags() & pygame.SRCALPHA, level.get_pitch(), offset])
+        offset += ((level.get_pitch() * level.get_height()) + 15) / 16 * 16
+    header = json.dumps(header)
+    header += " " * (-(len(TEXTURE_CACHE_MAGIC) + 4 + len(header)) % 16)
+
+    if not os.path.isdir(TEXTURE_CACHE_DIR):
+        os.makedirs(TEXTURE_CACHE_DIR)
+    temp_name = "%s.%d.%d.tmp" % (cache_name, os.getpid(), threading.current_thread().ident)
+    with open(temp_name, "wb") as f:
+        f.write(TEXTURE_CACHE_MAGIC)
+        f.write(struct.pack("<I", len(header)))
+        f.write(header)
+        for level in levels:
+            data = level.get_buffer().raw
+            f.write(data)
+            f.write("\0" * (-len(data) % 16))
+    os.rename(temp_name, cache_name)
+
+def load_texture_cache(cache_name):
+    # Copies the cached pixels of every mipmap level straight into new surfaces.
+    # Returns None if the file is missing or doesn't hold a cached texture.
+    try:
+        with open(cache_name, "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+    except (IOError, ValueError, mmap.error):
+        return None
+
+    try:
+        if data[:len(TEXTURE_CACHE_MAGIC)] != TEXTURE_CACHE_MAGIC:
+            return None
+        length = struct.unpack("<I", data[len(TEXTURE_CACHE_MAGIC):len(TEXTURE_CACHE_MAGIC) + 4])[0]
+        start = len(TEXTURE_CACHE_MAGIC) + 4 + length
+        header = json.loads(data[len(TEXTURE_CACHE_MAGIC) + 4:start])
+        if not isinstance(header, dict) or header.get("version") != TEXTURE_CACHE_VERSION:
+            return None
+
+        levels = []
+        for w, h, bitsize, masks, flags, pitch, offset in header["levels"]:
+            level = pygame.Surface((w, h), flags, bitsize, masks)
+            if level.get_pitch() != pitch or start + offset + (pitch * h) > len(data):
+                return None
+            level.get_buffer().write(data[start + offset:start + offset + (pitch * h)], 0)
+            levels.append(level)
+        return levels
+    except (struct.error, ValueError, KeyError, TypeError, pygame.error):
+        return None
+    finally:
+        data.close()
+
+def load_texture_levels(file_name, alpha = False):
+    # Returns the mipmap chain of a texture, decoding the file and caching the result only when the cache
+    # doesn't hold it yet. A cache that can't be written just leaves the texture uncached.
+    if not TEXTURE_CACHE:
+        return decode_texture(file_name, alpha)
+    cache_name = texture_cache_name(file_name, alpha)
+    levels = load_texture_cache(cache_name)
+    if levels is None:
+        levels = decode_texture(file_name, alpha)
+        try:
+            save_texture_cache(cache_name, levels)
+        except (IOError, OSError):
+            pass
+    return levels
+
+class TextureManager(object):
+    def __init__(self):
+        self.textures = {}
+
+    def load(self, file_name, alpha = False):
+        # Each file is loaded only once, every later request gets the same texture. With LAZY_TEXTURES the
+        # pixels are only loaded the first time they are used.
+        key = (file_name, alpha)
+        if key not in self.textures:
+            if LAZY_TEXTURES:
+                self.textures[key] = Texture.deferred(lambda: load_texture_levels(file_name, alpha))
+            else:
+                levels = load_texture_levels(file_name, alpha)
+                self.textures[key] = Texture(levels[0], levels)
+        return self.textures[key]
+
+    def prefetch(self, textures):
+        # Loads the given textures in order on a background thread and returns it.
+        # Processes must not be forked while it runs, render workers must be started before.
+        thread = threading.Thread(target = lambda: [texture.load() for texture in textures])
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def loaded(self):
+        return sum(1 for texture in self.textures.itervalues() if texture.loader is None)
+
+    def clear(self):
+        self.textures.clear()
+
+TEXTURES = TextureManager()
+
+##############################################################
+# Column Cache class
+##############################################################
+
+class ColumnCache(object):
+    def __init__(self, max_bytes = COLUMN_CACHE_SIZE):
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.scales = 0 # Calls to transform.scale, a sprite miss scales one column per texel column it covers
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "scales": self.scales,
+            "entries": len(self.entries),
+            "bytes": self.bytes,
+            "hit_rate": float(self.hits) / lookups if lookups > 0 else 0.0
+        }
+
+    def get(self, column, h, shade = None):
+        # Returns the column scaled to a height of h pixels and, if a shade is given, darkened by it.
+        # The columns must be long lived surfaces such as the precomputed strips of a Texture.
+        key = (column, h, shade)
+        scaled = self.lookup(key)
+        if scaled is not None:
+            return scaled
+
+        scaled = pygame.transform.scale(column, (column.get_width(), h))
+        self.scales += 1
+        if shade is not None:
+            scaled.fill((shade, shade, shade), pygame.Rect(0, 0, column.get_width(), h), pygame.BLEND_MULT)
+        return self.store(key, scaled)
+
+    def get_sprite(self, texture, size, shade):
+        # Returns a whole sprite texture scaled to size x size pixels and darkened by shade. It is built from the
+        # same scaled columns the walls use so drawing part of it matches drawing those columns one by one.
+        key = (texture, size, shade)
+        image = self.lookup(key)
+        if image is not None:
+            return image
+
+        # The columns are copied with a max blend so their alpha isn't blended with the empty image
+        image = pygame.Surface((size, size), pygame.SRCALPHA, texture.columns[0][0])
+        scaled = None
+        last = -1
+        for x in xrange(size):
+            tc = (x * texture.width) / size
+            if tc != last:
+                scaled = pygame.transform.scale(texture.get_column(tc), (1, size))
+                self.scales += 1
+                scaled.fill((shade, shade, shade), pygame.Rect(0, 0, 1, size), pygame.BLEND_MULT)
+                last = tc
+            image.blit(scaled, (x, 0), None, pygame.BLEND_RGBA_MAX)
+        return self.store(key, image)
+
+    def lookup(self, key):
+        scaled = self.entries.pop(key, None)
+        if scaled is None:
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        self.entries[key] = scaled
+        return scaled
+
+    def store(self, key, scaled):
+        size = scaled.get_bytesize() * scaled.get_width() * scaled.get_height()
+        if size > self.max_bytes:
+            return scaled
+
+        # Evict the least recently used columns until the new one fits
+        while self.bytes + size > self.max_bytes:
+            old_key, old = self.entries.popitem(last = False)
+            self.bytes -= old.get_bytesize() * old.get_width() * old.get_height()
+            self.evictions += 1
+
+        self.entries[key] = scaled
+        self.bytes += size
+        return scaled
+
+    def clear(self):
+        self.entries.clear()
+        self.bytes = 0
+
 ##############################################################
 # Line Segment Class
 ##############################################################
@@ -153,80 +693,866 @@ class LineSegment(object):
         self.n = vec2(-self.v.y, self.v.x)
         self.tca = tca
         self.tcb = tcb
-        self.texture = pygame.image.load(texture).convert()
+        # The texture can be either a file name or an already loaded texture
+        self.texture = texture if isinstance(texture, Texture) else TEXTURES.load(texture)
 
     def intersect(self, r):
-        def classifyPoint2D(point):
-            v1 = point.sub(self.a).normalize()
-            return v1.dot(self.n)
-
-        def sign(n):
-            if n == 0:
-                return 0
-            elif n > 0:
-                return 1
-            else:
-                return -1
+        # Works on the vector components directly so that no vectors are created unless there is a hit
+        o = r.o
+        d = r.d
 
-        def lerp(a, b, t):
-            return (a * t) + (b * (1.0 - t))
+        # Classify the ray origin against the wall
+        v1x = o.x - self.a.x
+        v1y = o.y - self.a.y
+        norm = math.sqrt((v1x * v1x) + (v1y * v1y))
+        side = ((v1x / norm) * self.n.x) + ((v1y / norm) * self.n.y) if norm > 0 else (v1x * self.n.x) + (v1y * self.n.y)
 
-        side = classifyPoint2D(r.o)
-        v2 = self.b.sub(self.a)
-        v3 = vec2(-r.d.y, r.d.x) if sign(side) > 0 else vec2(r.d.y, -r.d.x)
-        det = v2.dot(v3)
+        v2x = self.b.x - self.a.x
+        v2y = self.b.y - self.a.y
+        v3x, v3y = (-d.y, d.x) if side > 0 else (d.y, -d.x)
+        det = (v2x * v3x) + (v2y * v3y)
 
         if abs(det) < TOLERANCE:
             return None
         else:
-            v1 = r.o.sub(self.a)
-            t1 = v2.cross(v1).length() / det
-            t2 = v1.dot(v3) / det
+            t1 = abs((v2x * v1y) - (v2y * v1x)) / det
+            t2 = ((v1x * v3x) + (v1y * v3y)) / det
 
             if t2 >= 0.0 and t2 <= 1.0 and t1 > 0.0:
-                return Intersection(r, t1, lerp(self.tca, self.tcb, t2))
+                return Intersection(r, t1, (self.tca * t2) + (self.tcb * (1.0 - t2)))
             else:
                 return None
 
-    def get_tex_column(self, s):
-        w = self.texture.get_width()
-        h = self.texture.get_height()
-        _s = s * w if s >= 0.0 else (1.0 - (math.ceil(s) - s)) * w
-        _s = int(_s % w)
-        # Creating a subsurface is pretty fast in pygame, no copying of pixels is needed
-        return self.texture.subsurface(pygame.Rect(_s, 0, 1, h))
-    
+##############################################################
+# Wall Caster class
+##############################################################
+
+class WallCaster(object):
+    def __init__(self, walls):
+        self.tests = 0 # Number of ray-wall tests done by the last cast
+        self.a, self.b, self.n, self.tca, self.tcb, self.textures = self.pack(walls)
+        self.build()
+
+    @classmethod
+    def from_arrays(cls, a, b, n, tca, tcb, textures, grid = None):
+        # Creates a caster straight from packed wall arrays, textures holds the Texture of each wall.
+        # Casters that build an acceleration structure can take it already built in grid.
+        caster = cls.__new__(cls)
+        caster.tests = 0
+        caster.a, caster.b, caster.n, caster.tca, caster.tcb, caster.textures = a, b, n, tca, tcb, textures
+        if grid is None:
+            caster.build()
+        else:
+            caster.set_grid(grid)
+        return caster
+
+    def pack(self, walls):
+        # Pack the wall endpoints, normals and texture coordinates into arrays
+        n = len(walls)
+        a = np.array([(l.a.x, l.a.y) for l in walls], dtype = np.float64).reshape(n, 2)
+        b = np.array([(l.b.x, l.b.y) for l in walls], dtype = np.float64).reshape(n, 2)
+        normals = np.array([(l.n.x, l.n.y) for l in walls], dtype = np.float64).reshape(n, 2)
+        tca = np.array([l.tca for l in walls], dtype = np.float64)
+        tcb = np.array([l.tcb for l in walls], dtype = np.float64)
+        return a, b, normals, tca, tcb, [l.texture for l in walls]
+
+    def build(self):
+        # The brute force caster needs no acceleration structure
+        pass
+
+    def set_grid(self, grid):
+        pass
+
+    def add_walls(self, walls):
+        # Walls added at runtime are appended to the arrays and the acceleration structure is rebuilt
+        a, b, n, tca, tcb, textures = self.pack(walls)
+        self.a = np.concatenate((self.a, a))
+        self.b = np.concatenate((self.b, b))
+        self.n = np.concatenate((self.n, n))
+        self.tca = np.concatenate((self.tca, tca))
+        self.tcb = np.concatenate((self.tcb, tcb))
+        self.textures = self.textures + textures
+        self.build()
+
+    def num_walls(self):
+        return len(self.a)
+
+    def get_tex_column(self, wall, s, h = None):
+        return self.textures[wall].sample_column(s, h)
+
+    def ray_origins(self, origin, num_rays):
+        # The origin can be a vec2 shared by every ray or a vec2_array with the origin of each ray
+        return (np.broadcast_to(np.asarray(origin.x, dtype = np.float64), (num_rays,)),
+                np.broadcast_to(np.asarray(origin.y, dtype = np.float64), (num_rays,)))
+
+    def normalize_directions(self, directions):
+        norm = np.sqrt((directions[:, 0] * directions[:, 0]) + (directions[:, 1] * directions[:, 1]))
+        norm[norm == 0.0] = 1.0
+        return directions[:, 0] / norm, directions[:, 1] / norm
+
+    def intersect(self, ox, oy, dx, dy, walls):
+        # Tests rays against the walls with the given indices following the same steps as LineSegment.intersect.
+        # The ray origin and normalized direction arrays and the wall index array must broadcast against each other.
+        # Returns the hit mask, the hit distance, the hit point and the interpolation parameter along the wall.
+        ax = self.a[walls, 0]
+        ay = self.a[walls, 1]
+
+        # Classify the ray origin against every wall
+        v1x = ox - ax
+        v1y = oy - ay
+        v1_norm = np.sqrt((v1x * v1x) + (v1y * v1y))
+        v1_norm[v1_norm == 0.0] = 1.0
+        side = ((v1x / v1_norm) * self.n[walls, 0]) + ((v1y / v1_norm) * self.n[walls, 1])
+        sgn = np.where(side > 0.0, 1.0, -1.0)
+
+        v2x = self.b[walls, 0] - ax
+        v2y = self.b[walls, 1] - ay
+        v3x = -dy * sgn
+        v3y = dx * sgn
+        det = (v2x * v3x) + (v2y * v3y)
+
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            t1 = np.abs((v2x * v1y) - (v2y * v1x)) / det
+            t2 = ((v1x * v3x) + (v1y * v3y)) / det
+            hit = (np.abs(det) >= TOLERANCE) & (t2 >= 0.0) & (t2 <= 1.0) & (t1 > 0.0)
+            px = ox + (dx * t1)
+            py = oy + (dy * t1)
+            ex = px - ox
+            ey = py - oy
+            d = np.where(hit, np.sqrt((ex * ex) + (ey * ey)), float('Inf'))
+
+        return hit, d, px, py, t2
+
+    def cast(self, origin, directions, walls = None):
+        # Solves every ray against every wall at once, or only against the walls with the indices in walls.
+        # The origin is a vec2 or a vec2_array with one origin per ray.
+        # Returns the distance, hit point, texture coordinate and wall index of the closest hit of each ray.
+        # Rays that hit nothing get an infinite distance and a wall index of -1.
+        directions = np.asarray(directions, dtype = np.float64)
+        num_rays = directions.shape[0]
+        dists = np.empty(num_rays)
+        dists.fill(float('Inf'))
+        points = np.zeros((num_rays, 2))
+        tex_coords = np.zeros(num_rays)
+        indices = np.empty(num_rays, dtype = np.intp)
+        indices.fill(-1)
+        walls = np.arange(len(self.a)) if walls is None else np.asarray(walls, dtype = np.intp)
+        self.tests = num_rays * len(walls)
+
+        if num_rays == 0 or len(walls) == 0:
+            return dists, points, tex_coords, indices
+
+        ox, oy = self.ray_origins(origin, num_rays)
+        dx, dy = self.normalize_directions(directions)
+        hit, d, px, py, t2 = self.intersect(ox[:, np.newaxis], oy[:, np.newaxis], dx[:, np.newaxis], dy[:, np.newaxis], walls)
+
+        # Keep the closest hit for each ray, the first wall wins ties just like the sequential loop
+        self.closest(np.arange(num_rays), np.broadcast_to(walls, d.shape), d, px, py, t2,
+                     dists, points, tex_coords, indices)
+
+        return dists, points, tex_coords, indices
+
+    def closest(self, rays, walls, d, px, py, t2, dists, points, tex_coords, indices):
+        # Stores the closest hit of each row of candidates into the output arrays.
+        # Returns the mask of the rows that hit something.
+        rows = np.arange(d.shape[0])
+        best = np.argmin(d, axis = 1)
+        found = np.isfinite(d[rows, best])
+        rows = rows[found]
+        best = best[found]
+        wall = walls[rows, best]
+        t = t2[rows, best]
+        out = rays[found]
+
+        dists[out] = d[rows, best]
+        points[out, 0] = px[rows, best]
+        points[out, 1] = py[rows, best]
+        tex_coords[out] = (self.tca[wall] * t) + (self.tcb[wall] * (1.0 - t))
+        indices[out] = wall
+
+        return found
+
+    def check_parity(self, origin, directions, walls = None):
+        # Casts the rays with LineSegment.intersect against every wall and returns the indices of the rays whose
+        # closest hit differs from the result of cast. Only cast is given the subset of walls, the brute force
+        # pass always tests all of them so it also catches walls culled by mistake.
+        dists, points, tex_coords, indices = self.cast(origin, directions, walls)
+        walls = [LineSegment(vec2(self.a[k, 0], self.a[k, 1]), vec2(self.b[k, 0], self.b[k, 1]), self.tca[k], self.tcb[k], self.textures[k])
+                 for k in xrange(len(self.a))]
+        mismatches = []
+        r = Ray(vec2(origin.x, origin.y))
+        for i in xrange(len(directions)):
+            # The ray is reused, only its direction changes
+            r.d.set(float(directions[i][0]), float(directions[i][1])).inormalize()
+            d = float('Inf')
+            hit = None
+            index = -1
+            for k, l in enumerate(walls):
+                intersection = l.intersect(r)
+                if intersection is not None and intersection.d < d:
+                    d = intersection.d
+                    hit = intersection
+                    index = k
+
+            if index != indices[i]:
+                mismatches.append(i)
+            elif hit is not None and (abs(hit.d - dists[i]) > TOLERANCE or
+                                      abs(hit.tc - tex_coords[i]) > TOLERANCE or
+                                      abs(hit.p.x - points[i, 0]) > TOLERANCE or
+                                      abs(hit.p.y - points[i, 1]) > TOLERANCE):
+                mismatches.append(i)
+
+        return mismatches
+
+##############################################################
+# Wall Grid class
+##############################################################
+
+class WallGrid(WallCaster):
+    def build(self):
+        num_walls = len(self.a)
+        if num_walls == 0:
+            self.origin = np.zeros(2)
+            self.cell_size = 1.0
+            self.size = (1, 1)
+            self.cell_start = np.zeros(1, dtype = np.intp)
+            self.cell_count = np.zeros(1, dtype = np.intp)
+            self.cell_walls = np.zeros(0, dtype = np.intp)
+            return
+
+        # Size the cells so that each one holds a few walls on average
+        lo = np.minimum(self.a.min(axis = 0), self.b.min(axis = 0))
+        hi = np.maximum(self.a.max(axis = 0), self.b.max(axis = 0))
+        extent = hi - lo
+        cell_size = math.sqrt(max(extent[0] * extent[1], TOLERANCE) * GRID_WALLS_PER_CELL / num_walls)
+        cell_size = max(cell_size, extent.max() / GRID_MAX_CELLS, TOLERANCE)
+        nx = int(extent[0] / cell_size) + 1
+        ny = int(extent[1] / cell_size) + 1
+        self.origin = lo
+        self.cell_size = cell_size
+        self.size = (nx, ny)
+
+        # Register each wall in every cell its segment passes through
+        cells = [[] for k in xrange(nx * ny)]
+        eps = cell_size * 0.001
+        for k in xrange(num_walls):
+            ax, ay = self.a[k] - lo
+            bx, by = self.b[k] - lo
+            i0 = max(int((min(ax, bx) - eps) / cell_size), 0)
+            i1 = min(int((max(ax, bx) + eps) / cell_size), nx - 1)
+            j0 = max(int((min(ay, by) - eps) / cell_size), 0)
+            j1 = min(int((max(ay, by) + eps) / cell_size), ny - 1)
+            for j in xrange(j0, j1 + 1):
+                for i in xrange(i0, i1 + 1):
+                    # The segment crosses the cell unless all of the cell's corners lie on the same side of it
+                    sides = [((bx - ax) * (y - ay)) - ((by - ay) * (x - ax))
+                             for x in ((i * cell_size) - eps, ((i + 1) * cell_size) + eps)
+                             for y in ((j * cell_size) - eps, ((j + 1) * cell_size) + eps)]
+                    if min(sides) <= 0.0 <= max(sides):
+                        cells[(j * nx) + i].append(k)
+
+        self.cell_count = np.array([len(c) for c in cells], dtype = np.intp)
+        self.cell_start = np.concatenate(([0], np.cumsum(self.cell_count)[:-1])).astype(np.intp)
+        self.cell_walls = np.array([k for c in cells for k in c], dtype = np.intp)
+
+    def get_grid(self):
+        # Returns the grid as arrays that can be saved and given back to from_arrays
+        return {
+            "grid_origin": self.origin,
+            "grid_cell_size": np.array([self.cell_size]),
+            "grid_size": np.array(self.size, dtype = np.intp),
+            "cell_start": self.cell_start,
+            "cell_count": self.cell_count,
+            "cell_walls": self.cell_walls
+        }
+
+    def set_grid(self, grid):
+        self.origin = grid["grid_origin"]
+        self.cell_size = float(grid["grid_cell_size"][0])
+        self.size = (int(grid["grid_size"][0]), int(grid["grid_size"][1]))
+        self.cell_start = grid["cell_start"]
+        self.cell_count = grid["cell_count"]
+        self.cell_walls = grid["cell_walls"]
+
+    def cast(self, origin, directions, walls = None):
+        # Walks every ray through the grid cells it crosses with a DDA, all rays in lockstep.
+        # A ray stops at the first cell holding a wall hit that lies inside that cell.
+        # A subset of walls, like the visible walls of a sector map, is solved by brute force instead.
+        # Returns the same arrays as WallCaster.cast.
+        if walls is not None:
+            return WallCaster.cast(self, origin, directions, walls)
+        directions = np.asarray(directions, dtype = np.float64)
+        num_rays = directions.shape[0]
+        dists = np.empty(num_rays)
+        dists.fill(float('Inf'))
+        points = np.zeros((num_rays, 2))
+        tex_coords = np.zeros(num_rays)
+        indices = np.empty(num_rays, dtype = np.intp)
+        indices.fill(-1)
+        self.tests = 0
+
+        if num_rays == 0 or len(self.a) == 0:
+            return dists, points, tex_coords, indices
+
+        ox, oy = self.ray_origins(origin, num_rays)
+        dx, dy = self.normalize_directions(directions)
+        nx, ny = self.size
+        cs = self.cell_size
+
+        # Ray origins relative to the grid
+        gx = ox - self.origin[0]
+        gy = oy - self.origin[1]
+
+        with np.errstate(divide = 'ignore', invalid = 'ignore'):
+            # Clip the rays against the grid bounds
+            t_near = np.zeros(num_rays)
+            t_far = np.empty(num_rays)
+            t_far.fill(float('Inf'))
+            for dc, oc, n in ((dx, gx, nx), (dy, gy, ny)):
+                ta = (0.0 - oc) / dc
+                tb = ((n * cs) - oc) / dc
+                parallel = dc == 0.0
+                inside = (0.0 <= oc) & (oc <= n * cs)
+                t_near = np.maximum(t_near, np.where(parallel, np.where(inside, 0.0, float('Inf')), np.minimum(ta, tb)))
+                t_far = np.minimum(t_far, np.where(parallel, np.where(inside, float('Inf'), -1.0), np.maximum(ta, tb)))
+
+            rays = np.nonzero(t_near <= t_far)[0]
+            ox = ox[rays]
+            oy = oy[rays]
+            gx = gx[rays]
+            gy = gy[rays]
+            dx = dx[rays]
+            dy = dy[rays]
+            t_start = t_near[rays]
+
+            # Find the starting cell and the distance to the first cell boundary along each axis
+            cx = np.clip(np.floor((gx + (dx * t_start)) / cs).astype(np.intp), 0, nx - 1)
+            cy = np.clip(np.floor((gy + (dy * t_start)) / cs).astype(np.intp), 0, ny - 1)
+            step_x = np.where(dx > 0.0, 1, -1)
+            step_y = np.where(dy > 0.0, 1, -1)
+            delta_x = np.where(dx == 0.0, float('Inf'), cs / np.abs(dx))
+            delta_y = np.where(dy == 0.0, float('Inf'), cs / np.abs(dy))
+            t_max_x = np.where(dx == 0.0, float('Inf'), (((cx + (dx > 0.0)) * cs) - gx) / dx)
+            t_max_y = np.where(dy == 0.0, float('Inf'), (((cy + (dy > 0.0)) * cs) - gy) / dy)
+
+        while len(rays) > 0:
+            cell = (cy * nx) + cx
+            start = self.cell_start[cell]
+            count = self.cell_count[cell]
+            searching = np.ones(len(rays), dtype = bool)
+            k = count.max()
+
+            if k > 0:
+                # Gather the walls of each ray's current cell, padding the shorter lists
+                slots = np.arange(k)
+                valid = slots[np.newaxis, :] < count[:, np.newaxis]
+                walls = self.cell_walls[np.where(valid, start[:, np.newaxis] + slots[np.newaxis, :], 0)]
+                hit, d, px, py, t2 = self.intersect(ox[:, np.newaxis], oy[:, np.newaxis], dx[:, np.newaxis], dy[:, np.newaxis], walls)
+                self.tests += int(count.sum())
+
+                # Only accept hits inside the current cell, farther ones may be occluded by walls in the next cells
+                t_exit = np.minimum(t_max_x, t_max_y)
+                d = np.where(valid & hit & (d <= t_exit[:, np.newaxis] + TOLERANCE), d, float('Inf'))
+                searching = ~self.closest(rays, walls, d, px, py, t2, dists, points, tex_coords, indices)
+
+            # Step every ray still searching into its next cell
+            along_x = t_max_x < t_max_y
+            cx = np.where(along_x, cx + step_x, cx)
+            cy = np.where(along_x, cy, cy + step_y)
+            t_max_x = np.where(along_x, t_max_x + delta_x, t_max_x)
+            t_max_y = np.where(along_x, t_max_y, t_max_y + delta_y)
+            searching &= (cx >= 0) & (cx < nx) & (cy >= 0) & (cy < ny)
+
+            rays = rays[searching]
+            ox = ox[searching]
+            oy = oy[searching]
+            dx = dx[searching]
+            dy = dy[searching]
+            cx = cx[searching]
+            cy = cy[searching]
+            step_x = step_x[searching]
+            step_y = step_y[searching]
+            delta_x = delta_x[searching]
+            delta_y = delta_y[searching]
+            t_max_x = t_max_x[searching]
+            t_max_y = t_max_y[searching]
+
+        return dists, points, tex_coords, indices
+
+##############################################################
+# Sector map class
+##############################################################
+
+class SectorMap(object):
+    def __init__(self, polygons):
+        # Splits the world into convex sectors given by the vertices of their polygons. An edge shared by two
+        # sectors, with the same endpoints, is a portal between them. Walls and sprites are grouped by the sectors
+        # they touch, the ones outside of every sector go to an extra group that is always visible.
+        # The world must be closed: every edge of a sector that isn't a portal must be covered by walls.
+        vertices = []
+        starts = [0]
+        for k, polygon in enumerate(polygons):
+            polygon = [tuple(float(c) for c in v) for v in polygon]
+            if len(polygon) < 3:
+                raise ValueError("sector %d has less than 3 vertices" % k)
+
+            # Counterclockwise order puts the inside of the sector to the left of every edge
+            area = sum((a[0] * b[1]) - (b[0] * a[1]) for a, b in zip(polygon, polygon[1:] + polygon[:1]))
+            if area < 0.0:
+                polygon.reverse()
+            for a, b, c in zip(polygon, polygon[1:] + polygon[:1], polygon[2:] + polygon[:2]):
+                if ((b[0] - a[0]) * (c[1] - b[1])) - ((b[1] - a[1]) * (c[0] - b[0])) < -SECTOR_TOLERANCE:
+                    raise ValueError("sector %d is not convex" % k)
+
+            vertices.extend(polygon)
+            starts.append(len(vertices))
+
+        self.vertices = np.array(vertices, dtype = np.float64).reshape(len(vertices), 2)
+        self.starts = np.array(starts, dtype = np.intp)
+
+        # Find the portals, the edges walked the other way around by another sector
+        edges = {}
+        for s in xrange(len(starts) - 1):
+            for e in xrange(starts[s], starts[s + 1]):
+                edges[(vertices[e], vertices[e + 1 if e + 1 < starts[s + 1] else starts[s]])] = s
+        self.neighbours = np.empty(len(vertices), dtype = np.intp)
+        for s in xrange(len(starts) - 1):
+            for e in xrange(starts[s], starts[s + 1]):
+                self.neighbours[e] = edges.get((vertices[e + 1 if e + 1 < starts[s + 1] else starts[s]], vertices[e]), -1)
+
+        self.closed = np.zeros(len(vertices), dtype = bool)
+        self.wall_starts = np.zeros(len(starts) + 1, dtype = np.intp)
+        self.wall_ids = np.zeros(0, dtype = np.intp)
+        self.sprite_starts = np.zeros(len(starts) + 1, dtype = np.intp)
+        self.sprite_ids = np.zeros(0, dtype = np.intp)
+        self.build()
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        # Creates a sector map from the arrays returned by get_arrays, walls and sprites already assigned
+        sectors = cls.__new__(cls)
+        sectors.vertices = arrays["sector_vertices"]
+        sectors.starts = arrays["sector_starts"]
+        sectors.neighbours = arrays["sector_neighbours"]
+        sectors.closed = arrays["sector_closed"]
+        sectors.wall_starts = arrays["sector_wall_starts"]
+        sectors.wall_ids = arrays["sector_walls"]
+        sectors.sprite_starts = arrays["sector_sprite_starts"]
+        sectors.sprite_ids = arrays["sector_sprites"]
+        sectors.build()
+        return sectors
+
+    def get_arrays(self):
+        return {
+            "sector_vertices": self.vertices,
+            "sector_starts": self.starts,
+            "sector_neighbours": self.neighbours,
+            "sector_closed": self.closed,
+            "sector_wall_starts": self.wall_starts,
+            "sector_walls": self.wall_ids,
+            "sector_sprite_starts": self.sprite_starts,
+            "sector_sprites": self.sprite_ids
+        }
+
+    def build(self):
+        # Computes the inward unit normal of every edge and the list of portals of every sector
+        starts = self.starts.tolist()
+        following = np.arange(1, len(self.vertices) + 1)
+        following[self.starts[1:] - 1] = self.starts[:-1]
+        self.edge_a = self.vertices
+        self.edge_b = self.vertices[following]
+        v = self.edge_b - self.edge_a
+        norm = np.sqrt((v[:, 0] * v[:, 0]) + (v[:, 1] * v[:, 1]))
+        norm[norm == 0.0] = 1.0
+        self.edge_n = np.column_stack((-v[:, 1] / norm, v[:, 0] / norm))
+        self.edge_c = (self.edge_n[:, 0] * self.edge_a[:, 0]) + (self.edge_n[:, 1] * self.edge_a[:, 1])
+
+        self.portals = []
+        for s in xrange(len(starts) - 1):
+            self.portals.append([(int(self.neighbours[e]), bool(self.closed[e])) + tuple(self.edge_a[e].tolist()) +
+                                 tuple(self.edge_b[e].tolist()) + tuple(self.edge_n[e].tolist()) + (float(self.edge_c[e]),)
+                                 for e in xrange(starts[s], starts[s + 1]) if self.neighbours[e] >= 0])
+        self.last = 0
+
+    def num_sectors(self):
+        return len(self.starts) - 1
+
+    def sides(self, x, y):
+        # Signed distance of the points to the line of every edge, positive inside of its sector
+        return (np.multiply.outer(x, self.edge_n[:, 0]) + np.multiply.outer(y, self.edge_n[:, 1])) - self.edge_c
+
+    def locate(self, x, y):
+        # Returns the index of the sector holding each point, -1 for the points outside of every sector.
+        # Points on an edge shared by two sectors go to the first one.
+        x = np.asarray(x, dtype = np.float64)
+        y = np.asarray(y, dtype = np.float64)
+        sectors = np.empty(x.shape, dtype = np.intp)
+        sectors.fill(-1)
+        if self.num_sectors() == 0:
+            return sectors
+
+        # Points are tested in batches to bound the size of the point by edge matrix
+        flat_x = x.ravel()
+        flat_y = y.ravel()
+        flat = sectors.ravel()
+        step = max(1, 1000000 / len(self.vertices))
+        for i in xrange(0, len(flat_x), step):
+            inside = np.minimum.reduceat(self.sides(flat_x[i:i + step], flat_y[i:i + step]), self.starts[:-1], axis = 1) >= -SECTOR_TOLERANCE
+            flat[i:i + step] = np.where(inside.any(axis = 1), np.argmax(inside, axis = 1), -1)
+        return flat.reshape(x.shape)
+
+    def locate_camera(self, pos):
+        # Scalar locate for the camera, which usually stays in the sector it was last found in
+        s = self.last
+        if s < self.num_sectors():
+            e0, e1 = self.starts[s], self.starts[s + 1]
+            if (((self.edge_n[e0:e1, 0] * pos.x) + (self.edge_n[e0:e1, 1] * pos.y)) - self.edge_c[e0:e1]).min() >= -SECTOR_TOLERANCE:
+                return s
+        s = int(self.locate(pos.x, pos.y))
+        if s >= 0:
+            self.last = s
+        return s
+
+    def overlap(self, a, b, s):
+        # Mask of the segments from a to b that touch sector s, clipped against the inside of every edge
+        t0 = np.zeros(len(a))
+        t1 = np.ones(len(a))
+        dx = b[:, 0] - a[:, 0]
+        dy = b[:, 1] - a[:, 1]
+        for e in xrange(self.starts[s], self.starts[s + 1]):
+            nx, ny = self.edge_n[e]
+            num = ((a[:, 0] * nx) + (a[:, 1] * ny)) - self.edge_c[e] + SECTOR_TOLERANCE
+            den = (dx * nx) + (dy * ny)
+            with np.errstate(divide = "ignore", invalid = "ignore"):
+                t = -num / den
+            t0 = np.where(den > 0.0, np.maximum(t0, t), t0)
+            t1 = np.where(den < 0.0, np.minimum(t1, t), t1)
+            t1 = np.where((den == 0.0) & (num < 0.0), -1.0, t1)
+        return t0 <= t1
+
+    def assign(self, wall_a, wall_b, sprite_positions):
+        # Groups the walls by the sectors they touch and the sprites by the sector holding them.
+        # Must be called again after walls or sprites are added or moved.
+        num_sectors = self.num_sectors()
+        groups = []
+        grouped = np.zeros(len(wall_a), dtype = bool)
+        lo = np.minimum(wall_a, wall_b)
+        hi = np.maximum(wall_a, wall_b)
+        for s in xrange(num_sectors):
+            # Only clip the walls whose bounding box touches the one of the sector
+            vertices = self.vertices[self.starts[s]:self.starts[s + 1]]
+            box_lo = vertices.min(axis = 0) - SECTOR_TOLERANCE
+            box_hi = vertices.max(axis = 0) + SECTOR_TOLERANCE
+            near = np.flatnonzero((hi[:, 0] >= box_lo[0]) & (hi[:, 1] >= box_lo[1]) & (lo[:, 0] <= box_hi[0]) & (lo[:, 1] <= box_hi[1]))
+            walls = near[self.overlap(wall_a[near], wall_b[near], s)]
+            grouped[walls] = True
+            groups.append(walls)
+        groups.append(np.flatnonzero(~grouped))
+        self.wall_starts = np.concatenate(([0], np.cumsum([len(g) for g in groups]))).astype(np.intp)
+        self.wall_ids = np.concatenate(groups).astype(np.intp)
+
+        # An edge shared with another sector is closed when a single wall covers it
+        self.closed = np.zeros(len(self.vertices), dtype = bool)
+        edge_sectors = np.searchsorted(self.starts, np.arange(len(self.vertices)), side = "right") - 1
+        for e in np.flatnonzero(self.neighbours >= 0).tolist():
+            walls = groups[edge_sectors[e]]
+            a = wall_a[walls]
+            v = wall_b[walls] - a
+            length_sq = (v[:, 0] * v[:, 0]) + (v[:, 1] * v[:, 1])
+            length_sq[length_sq == 0.0] = 1.0
+            covered = np.ones(len(walls), dtype = bool)
+            for p in (self.edge_a[e], self.edge_b[e]):
+                t = np.clip((((p[0] - a[:, 0]) * v[:, 0]) + ((p[1] - a[:, 1]) * v[:, 1])) / length_sq, 0.0, 1.0)
+                dx = a[:, 0] + (v[:, 0] * t) - p[0]
+                dy = a[:, 1] + (v[:, 1] * t) - p[1]
+                covered &= ((dx * dx) + (dy * dy)) <= SECTOR_TOLERANCE * SECTOR_TOLERANCE
+            self.closed[e] = covered.any()
+        self.build()
+
+        # Sprites outside of every sector go to the last group
+        sectors = self.locate(sprite_positions[:, 0], sprite_positions[:, 1])
+        sectors[sectors < 0] = num_sectors
+        self.sprite_ids = np.argsort(sectors, kind = "mergesort").astype(np.intp)
+        self.sprite_starts = np.searchsorted(sectors[self.sprite_ids], np.arange(num_sectors + 2)).astype(np.intp)
+
+    def visible(self, player_pos, player_dir, plane, width, x0 = 0, x1 = None):
+        # Returns the sorted indices of the sectors seen by the columns x0 to x1 of a frame buffer of the given
+        # width, walking from the sector of the camera through the portals the columns see into, or None if the
+        # camera is outside of every sector. The set can hold a few sectors that end up hidden but never misses one.
+        x1 = width if x1 is None else x1
+        start = self.locate_camera(player_pos)
+        if start < 0:
+            return None
+
+        px, py = player_pos.x, player_pos.y
+        inv_det = 1.0 / ((plane.x * player_dir.y) - (player_dir.x * plane.y))
+        half = width / 2.0
+        covered = {start: [(x0, x1)]}
+        stack = [(start, x0, x1, 0)]
+        while stack:
+            s, c0, c1, depth = stack.pop()
+            if depth >= SECTOR_MAX_DEPTH:
+                continue
+            for neighbour, closed, ax, ay, bx, by, nx, ny, c in self.portals[s]:
+                # Past the sector of the camera only the portals leaving the sector can lead further away
+                side = (nx * px) + (ny * py) - c
+                if s != start and side <= SECTOR_TOLERANCE:
+                    continue
+
+                # A camera standing on the edge sees into the neighbour with every column, even through a wall
+                # since rays don't hit the wall they start on
+                vx, vy = bx - ax, by - ay
+                t = (((px - ax) * vx) + ((py - ay) * vy)) / max((vx * vx) + (vy * vy), SECTOR_TOLERANCE)
+                if abs(side) <= SECTOR_TOLERANCE and -SECTOR_TOLERANCE <= t <= 1.0 + SECTOR_TOLERANCE:
+                    lo, hi = c0, c1
+                elif closed:
+                    continue
+                else:
+                    # Take the ends of the portal to camera space, the camera_x of the column seeing a point is x / y
+                    ex, ey = ax - px, ay - py
+                    ta_x = inv_det * ((player_dir.y * ex) - (player_dir.x * ey))
+                    ta_y = inv_det * ((plane.x * ey) - (plane.y * ex))
+                    ex, ey = bx - px, by - py
+                    tb_x = inv_det * ((player_dir.y * ex) - (player_dir.x * ey))
+                    tb_y = inv_det * ((plane.x * ey) - (plane.y * ex))
+
+                    if ta_y <= SECTOR_TOLERANCE and tb_y <= SECTOR_TOLERANCE:
+                        continue
+
+                    # Clip the portal to the part in front of the camera
+                    if ta_y <= SECTOR_TOLERANCE:
+                        t = (SECTOR_TOLERANCE - ta_y) / (tb_y - ta_y)
+                        ta_x, ta_y = ta_x + ((tb_x - ta_x) * t), SECTOR_TOLERANCE
+                    elif tb_y <= SECTOR_TOLERANCE:
+                        t = (SECTOR_TOLERANCE - tb_y) / (ta_y - tb_y)
+                        tb_x, tb_y = tb_x + ((ta_x - tb_x) * t), SECTOR_TOLERANCE
+
+                    # Columns whose camera_x lies between the ones of the ends, rounded outwards
+                    u0, u1 = sorted((ta_x / ta_y, tb_x / tb_y))
+                    lo = max(c0, int(math.floor((u0 + 1.0) * half)) - 1) if u0 > -1.0 else c0
+                    hi = min(c1, int(math.ceil((u1 + 1.0) * half)) + 1) if u1 < 1.0 else c1
+                    if lo >= hi:
+                        continue
+
+                # Skip the columns already walked into the neighbour
+                ranges = covered.setdefault(neighbour, [])
+                if any(r0 <= lo and hi <= r1 for r0, r1 in ranges):
+                    continue
+                ranges.append((lo, hi))
+                stack.append((neighbour, lo, hi, depth + 1))
+
+        return sorted(covered)
+
+    def walls(self, sectors):
+        # Sorted indices of the walls touching the given sectors and of the walls outside of every sector
+        groups = [self.wall_ids[self.wall_starts[s]:self.wall_starts[s + 1]] for s in sectors + [self.num_sectors()]]
+        return np.unique(np.concatenate(groups))
+
+    def sprites(self, sectors):
+        # Sorted indices of the sprites inside the given sectors and of the sprites outside of every sector
+        groups = [self.sprite_ids[self.sprite_starts[s]:self.sprite_starts[s + 1]] for s in sectors + [self.num_sectors()]]
+        return np.sort(np.concatenate(groups))
+
 ##############################################################
 # Plane3D class
 ##############################################################
     
 class Plane3d(object):
     def __init__(self, texture):
-        self.texture = pygame.image.load(texture).convert()
+        self.texture = TEXTURES.load(texture)
 
     def sample_texture(self, st):
-        w = self.texture.get_width()
-        h = self.texture.get_height()
+        w = self.texture.width
+        h = self.texture.height
         s = st.x * w if st.x >= 0.0 else (1.0 - (math.ceil(st.x) - st.x)) * w
         s = int(s % w)
         t = st.y * h if st.y >= 0.0 else (1.0 - (math.ceil(st.y) - st.y)) * h
         t = int(t % h)
         return pygame.Rect(s, t, 1, 1)
 
+    def sample_texels(self, s, t):
+        # Same as sample_texture but for arrays of texture coordinates, returns the texel colors
+        w = self.texture.width
+        h = self.texture.height
+        s = np.where(s >= 0.0, s * w, (1.0 - (np.ceil(s) - s)) * w)
+        s = np.minimum((s % w).astype(np.intp), w - 1)
+        t = np.where(t >= 0.0, t * h, (1.0 - (np.ceil(t) - t)) * h)
+        t = np.minimum((t % h).astype(np.intp), h - 1)
+        return self.texture.pixels[s, t]
+
+##############################################################
+# Projection class
+##############################################################
+
+def distance_shade(d):
+    # Darkening factor of surfaces at the distances d, from 255 next to the camera down to 0 at FAR
+    return 255 - ((np.minimum(d, FAR) / FAR) * 255).astype(np.intp)
+
+def field_of_view(player_dir, plane):
+    return 2.0 * math.atan((plane.length() / player_dir.length())) * RAD2DEG
+
+class Projection(object):
+    def __init__(self, size, fov):
+        # Tables that only depend on the frame buffer size and the field of view
+        w, h = size
+        self.size = size
+        self.fov = fov
+
+        # Camera space offset of every column from -1 on the left to 1 on the right. Each column's ray in camera
+        # space is (1, camera_x), the [dir plane] camera matrix takes them to world space.
+        self.camera_x = 2.0 * (np.arange(w) / float(w)) - 1
+        self.rays = np.column_stack((np.ones(w), self.camera_x))
+
+        # Angle of every column relative to the view direction, accumulated from the first column, and the cosine
+        # that corrects the fisheye effect
+        increment = fov / float(w)
+        self.angles = np.cumsum(np.concatenate(([-fov / 2.0], np.repeat(increment, w - 1))))
+        self.cos_angles = np.cos(self.angles * DEG2RAD)
+
+        # Distance and shade of every floor row below the horizon, the row h is off screen but its ceiling row is not
+        self.rows = np.arange((h / 2) + 1, h + 1)
+        self.row_dists = h / ((2.0 * self.rows) - h)
+        self.row_shades = distance_shade(self.row_dists)
+
+    def matches(self, size, fov):
+        # Rotating the camera vectors in place makes their lengths drift a little, that alone doesn't rebuild the tables
+        return size == self.size and abs(fov - self.fov) < PROJECTION_FOV_TOLERANCE
+
+    def ray_directions(self, player_dir, plane, c0, c1):
+        # Applies the camera matrix to the rays of the columns c0 to c1
+        rays = self.rays[c0:c1]
+        directions = np.empty((c1 - c0, 2))
+        directions[:, 0] = (player_dir.x * rays[:, 0]) + (plane.x * rays[:, 1])
+        directions[:, 1] = (player_dir.y * rays[:, 0]) + (plane.y * rays[:, 1])
+        return directions
+
+##############################################################
+# Floor Caster class
+##############################################################
+
+def blend_mult_bias():
+    # Pygame 2 rounds the products of BLEND_MULT up, adding 255 before dividing by 256, while Pygame 1 truncates
+    # them. Returns the number added by the running version.
+    probe = pygame.Surface((1, 1), 0, 32)
+    probe.fill((255, 255, 255))
+    probe.fill((1, 1, 1), None, pygame.BLEND_MULT)
+    return 255 if probe.get_at((0, 0))[0] == 1 else 0
+
+class FloorCaster(object):
+    def __init__(self, floor, ceiling):
+        self.floor = floor
+        self.ceiling = ceiling
+        self.bias = blend_mult_bias()
+
+    def shade(self, texels, depth):
+        # Same as filling with pygame.BLEND_MULT using a (depth, depth, depth) color
+        return ((texels.astype(np.intp) * depth[:, np.newaxis]) + self.bias) >> 8
+
+    def render(self, frame_buffer, projection, player_pos, points, proj_dists, heights, draw_ceiling = True):
+        # Casts the floor and ceiling of every column below and above its wall slice all at once.
+        # Columns with a zero height or a wall taller than the frame buffer are left untouched.
+        h = frame_buffer.get_height()
+        cols = np.nonzero((heights > 0) & (heights < h))[0]
+        if len(cols) == 0:
+            return
+
+        # Find every floor pixel of every column
+        rows = projection.rows
+        start = (heights[cols] / 2) + (h / 2)
+        r, c = np.nonzero(rows[:, np.newaxis] >= start[np.newaxis, :])
+        j = rows[r]
+        i = cols[c]
+
+        # Interpolate between the player and the wall hit point according to the distance of each row
+        cd = projection.row_dists[r]
+        weight = cd / proj_dists[i]
+        s = (weight * points[i, 0]) + ((1.0 - weight) * player_pos.x)
+        t = (weight * points[i, 1]) + ((1.0 - weight) * player_pos.y)
+
+        # Darken according to distance
+        depth = projection.row_shades[r]
+
+        pixels = pygame.surfarray.pixels3d(frame_buffer)
+        on_screen = j < h
+        pixels[i[on_screen], j[on_screen]] = self.shade(self.floor.sample_texels(s[on_screen], t[on_screen]), depth[on_screen])
+        if draw_ceiling:
+            pixels[i, h - j] = self.shade(self.ceiling.sample_texels(s, t), depth)
+        del pixels
+
 ##############################################################
-# Sprite class
+# Sprite classes
 ##############################################################
     
 class Sprite(object):
     def __init__(self, position, texture):
         self.p = position
-        self.d = 0.0
-        self.texture = pygame.image.load(texture).convert_alpha()
-
-    def sample_texture(self, s):
-        _s = s % self.texture.get_width()
-        # Creating a subsurface is pretty fast in pygame, no copying of pixels is needed
-        return self.texture.subsurface(pygame.Rect(_s, 0, 1, self.texture.get_height()))
+        self.texture = TEXTURES.load(texture, alpha = True)
+
+class SpriteSet(object):
+    def __init__(self, sprites = []):
+        # The sprite positions are kept in an array and their textures as indices into a list of unique textures
+        # so that all of them can be culled, projected and sorted at once
+        self.positions, self.texture_ids, self.textures = self.pack(sprites, [])
+
+    @classmethod
+    def from_arrays(cls, positions, texture_ids, textures):
+        sprite_set = cls.__new__(cls)
+        sprite_set.positions = positions
+        sprite_set.texture_ids = texture_ids
+        sprite_set.textures = textures
+        return sprite_set
+
+    def pack(self, sprites, textures):
+        textures = list(textures)
+        texture_ids = []
+        for s in sprites:
+            if s.texture not in textures:
+                textures.append(s.texture)
+            texture_ids.append(textures.index(s.texture))
+
+        n = len(sprites)
+        positions = np.array([(s.p.x, s.p.y) for s in sprites], dtype = np.float64).reshape(n, 2)
+        return positions, np.array(texture_ids, dtype = np.int32), textures
+
+    def add_sprites(self, sprites):
+        positions, texture_ids, self.textures = self.pack(sprites, self.textures)
+        self.positions = np.concatenate((self.positions, positions))
+        self.texture_ids = np.concatenate((self.texture_ids, texture_ids))
+
+    def __len__(self):
+        return len(self.positions)
+
+    def project(self, player_pos, player_dir, plane, size, candidates = None):
+        # Culls the sprites behind the camera, beyond FAR or outside of the screen and returns the index, screen
+        # column, size in pixels and eye space depth of the rest, sorted from the farthest to the closest.
+        # Only the sprites with the sorted indices in candidates are considered if it is given.
+        w, h_fb = size
+        positions = self.positions if candidates is None else self.positions[candidates]
+        eye = vec2_array.from_array(positions).sub(player_pos)
+
+        # Apply the inverse camera matrix to every sprite
+        inv_det = 1.0 / ((plane.x * player_dir.y) - (player_dir.x * plane.y))
+        tx = inv_det * eye.dot(vec2(player_dir.y, -player_dir.x))
+        ty = inv_det * eye.dot(vec2(-plane.y, plane.x))
+
+        visible = np.nonzero((ty > 0.0) & (ty < FAR))[0]
+        tx = tx[visible]
+        ty = ty[visible]
+
+        # Compute sprite x position in image space and size, the sprites are always square.
+        # The size is clamped like the walls so a sprite touching the camera doesn't overflow.
+        with np.errstate(divide = "ignore", over = "ignore"):
+            screen_x = ((w / 2) * (1.0 + (tx / ty))).astype(np.intp)
+            size = np.minimum(h_fb / ty, HEIGHT_CLAMP_MULTIPLER * h_fb).astype(np.intp)
+        left = (-size // 2) + screen_x
+        right = (size // 2) + screen_x
+        on_screen = (right > 0) & (left < w) & (right > left)
+
+        # Sort by distance to the camera so that closer sprites are drawn over farther ones
+        visible = visible[on_screen]
+        order = np.argsort(-eye.lengthSQ()[visible], kind = "mergesort")
+        indices = visible[order] if candidates is None else candidates[visible[order]]
+        return indices, screen_x[on_screen][order], size[on_screen][order], ty[on_screen][order]
 
 ##############################################################
 # Sky class
@@ -234,26 +1560,1109 @@ class Sprite(object):
 
 class Sky(object):
     def __init__(self, texture):
-        self.texture = pygame.image.load(texture).convert_alpha()
+        self.texture = TEXTURES.load(texture, alpha = True)
+
+class SkyPanorama(object):
+    def __init__(self, sky, projection):
+        # The whole 360 degrees of sky resampled at the frame buffer scale, one column per column of the screen.
+        # The width is rounded to a whole number of columns so the panorama wraps around seamlessly.
+        texture = sky.texture
+        self.sky = sky
+        self.projection = projection
+        self.width = int(round(360.0 / (projection.fov / float(projection.size[0]))))
+        self.height = texture.height
+
+        # The sky texture repeats every 90 degrees, pick its column for the angle of each panorama column
+        angles = np.arange(self.width) * (360.0 / self.width)
+        s = ((angles / 90.0) * texture.width).astype(np.intp) % texture.width
+        self.surface = pygame.Surface((self.width, self.height), pygame.SRCALPHA, texture.surface)
+        pygame.surfarray.pixels3d(self.surface)[:] = texture.pixels[s]
+        pygame.surfarray.pixels_alpha(self.surface)[:] = pygame.surfarray.pixels_alpha(texture.surface)[s]
+
+    def draw(self, frame_buffer, p_angle, x0, x1, rows):
+        # Draws the top rows of the sky seen by the columns x0 to x1 with one blit, or two where it wraps around.
+        # Returns the number of blits.
+        first = int(round(((p_angle + self.projection.angles[0]) % 360.0) * self.width / 360.0))
+        offset = (first + x0) % self.width
+        rows = min(rows, self.height)
+        blits = 0
+        while x0 < x1:
+            span = min(x1 - x0, self.width - offset)
+            frame_buffer.blit(self.surface, (x0, 0), pygame.Rect(offset, 0, span, rows))
+            x0 += span
+            offset = 0
+            blits += 1
+        return blits
+
+##############################################################
+# Profiler class
+##############################################################
+
+class Profiler(object):
+    def __init__(self, window = PROFILER_WINDOW):
+        # The profiler does nothing until it is enabled
+        self.enabled = False
+        self.window = window
+        self.stages = collections.OrderedDict()
+        self.counters = collections.OrderedDict()
+        self.frame_times = collections.OrderedDict()
+        self.frame_counts = collections.OrderedDict()
+        self.started = {}
+        self.font = None
+
+    def start(self, stage):
+        if self.enabled:
+            self.started[stage] = timeit.default_timer()
+
+    def stop(self, stage):
+        # Stages started before the profiler was enabled are ignored
+        if self.enabled and stage in self.started:
+            elapsed = timeit.default_timer() - self.started.pop(stage)
+            self.frame_times[stage] = self.frame_times.get(stage, 0.0) + elapsed
+
+    def count(self, counter, n = 1):
+        if self.enabled:
+            self.frame_counts[counter] = self.frame_counts.get(counter, 0) + n
+
+    def add(self, stage, elapsed):
+        # Adds seconds measured elsewhere, like in a render worker, to a stage of the current frame
+        if self.enabled:
+            self.frame_times[stage] = self.frame_times.get(stage, 0.0) + elapsed
+
+    def take_frame(self):
+        # Returns the times and counts of the current frame so far and starts over, for render workers to send
+        # theirs to the main process
+        times, counts = self.frame_times, self.frame_counts
+        self.frame_times = collections.OrderedDict()
+        self.frame_counts = collections.OrderedDict()
+        return times, counts
+
+    def end_frame(self):
+        # Moves the times and counts of the frame that just ended into the rolling statistics
+        if not self.enabled:
+            return
+        for stage, elapsed in self.frame_times.iteritems():
+            if stage not in self.stages:
+                self.stages[stage] = collections.deque(maxlen = self.window)
+            self.stages[stage].append(elapsed * 1000.0)
+        for counter, n in self.frame_counts.iteritems():
+            if counter not in self.counters:
+                self.counters[counter] = collections.deque(maxlen = self.window)
+            self.counters[counter].append(n)
+        self.frame_times = collections.OrderedDict()
+        self.frame_counts = collections.OrderedDict()
+
+    def reset(self):
+        self.stages.clear()
+        self.counters.clear()
+        self.started.clear()
+        self.frame_times = collections.OrderedDict()
+        self.frame_counts = collections.OrderedDict()
+
+    def stats(self):
+        stages = collections.OrderedDict()
+        for stage, times in self.stages.iteritems():
+            stages[stage] = {"mean_ms": sum(times) / len(times), "max_ms": max(times)}
+        counters = collections.OrderedDict()
+        for counter, counts in self.counters.iteritems():
+            counters[counter] = {"mean": float(sum(counts)) / len(counts), "max": max(counts)}
+        return {"stages": stages, "counters": counters}
+
+    def dump(self, file_name = PROFILER_FILE):
+        with open(file_name, "w") as f:
+            json.dump(self.stats(), f, indent = 2)
+
+    def draw(self, surface):
+        # Draws the rolling means in the top left corner of the surface
+        if self.font is None:
+            self.font = pygame.font.Font(None, 12)
+        stats = self.stats()
+        lines = ["%-12s %6.2f ms" % (stage, st["mean_ms"]) for stage, st in stats["stages"].iteritems()]
+        lines.append("%-12s %6.2f ms" % ("total", sum(st["mean_ms"] for st in stats["stages"].itervalues())))
+        lines += ["%-12s %8.0f" % (counter, st["mean"]) for counter, st in stats["counters"].iteritems()]
+        y = 1
+        for line in lines:
+            text = self.font.render(line, False, (255, 255, 0))
+            surface.fill((0, 0, 0), pygame.Rect(1, y, text.get_width(), text.get_height()))
+            surface.blit(text, (1, y))
+            y += text.get_height()
+
+##############################################################
+# Scene class
+##############################################################
 
-    def sample_texture(self, angle):
-        s = int((angle / 90.0) * self.texture.get_width()) % self.texture.get_width()
-        return self.texture.subsurface(pygame.Rect(s, 0, 1, self.texture.get_height()))
+class Scene(object):
+    def __init__(self, walls, floor, ceiling, sky, sprites, sectors = None):
+        # The walls can be either a list of LineSegments or an already built WallCaster
+        self.caster = walls if isinstance(walls, WallCaster) else WallGrid(walls)
+        self.floor = floor
+        self.ceiling = ceiling
+        self.floor_caster = FloorCaster(floor, ceiling)
+        self.sky = sky
+
+        # Bumped by every change made through the scene so renderers know their last frame is out of date.
+        # Changes made directly to the caster or sprite arrays must call touch.
+        self.version = 0
+
+        # The sprites can be either a list of Sprites or an already built SpriteSet
+        self.sprites = sprites if isinstance(sprites, SpriteSet) else SpriteSet(sprites)
+
+        # The optional sectors can be either a list of convex polygons or a SectorMap with the walls and sprites
+        # already assigned. Without sectors every frame considers every wall and sprite.
+        self.sectors = sectors
+        if sectors is not None and not isinstance(sectors, SectorMap):
+            self.sectors = SectorMap(sectors)
+            self.assign_sectors()
+
+    def add_walls(self, walls):
+        self.caster.add_walls(walls)
+        self.assign_sectors()
+        self.touch()
+
+    def add_sprites(self, sprites):
+        self.sprites.add_sprites(sprites)
+        self.assign_sectors()
+        self.touch()
+
+    def assign_sectors(self):
+        if self.sectors is not None:
+            self.sectors.assign(self.caster.a, self.caster.b, self.sprites.positions)
+
+    def textures_near(self, pos, radius):
+        # Textures of the floor, the ceiling and the walls and sprites within radius of pos, closest first
+        textures = [self.floor.texture, self.ceiling.texture]
+        a, b = self.caster.a, self.caster.b
+        if len(a) > 0:
+            # Distance from pos to the closest point of every wall
+            v = b - a
+            length_sq = (v[:, 0] * v[:, 0]) + (v[:, 1] * v[:, 1])
+            length_sq[length_sq == 0.0] = 1.0
+            t = np.clip((((pos.x - a[:, 0]) * v[:, 0]) + ((pos.y - a[:, 1]) * v[:, 1])) / length_sq, 0.0, 1.0)
+            dx = a[:, 0] + (v[:, 0] * t) - pos.x
+            dy = a[:, 1] + (v[:, 1] * t) - pos.y
+            d = np.sqrt((dx * dx) + (dy * dy))
+            near = np.flatnonzero(d <= radius)
+            textures.extend(self.caster.textures[k] for k in near[np.argsort(d[near], kind = "mergesort")].tolist())
+        if len(self.sprites) > 0:
+            d = vec2_array.from_array(self.sprites.positions).sub(pos).length()
+            near = np.flatnonzero(d <= radius)
+            textures.extend(self.sprites.textures[self.sprites.texture_ids[k]] for k in near[np.argsort(d[near], kind = "mergesort")].tolist())
+
+        unique = []
+        for texture in textures:
+            if not any(texture is u for u in unique):
+                unique.append(texture)
+        return unique
+
+    def visible_sectors(self, player_pos, player_dir, plane, width, x0 = 0, x1 = None):
+        # Sectors the columns x0 to x1 can see, or None without sectors
+        return self.sectors.visible(player_pos, player_dir, plane, width, x0, x1) if self.sectors is not None else None
+
+    def visible_walls(self, sectors):
+        # Indices of the walls in the given visible sectors, or None when every wall must be considered
+        if sectors is None:
+            return None
+        walls = self.sectors.walls(sectors)
+        return walls if len(walls) <= SECTOR_MAX_WALLS else None
+
+    def visible_sprites(self, sectors):
+        # Indices of the sprites in the given visible sectors, or None when every sprite must be considered
+        return self.sectors.sprites(sectors) if sectors is not None else None
+
+    def touch(self):
+        self.version += 1
+
+##############################################################
+# Level loading
+##############################################################
+
+def parse_level(file_name):
+    # Reads a level text file, see Levels/sample.lvl for the format
+    level = {
+        "floor": FLOOR_TEXTURE,
+        "ceiling": CEIL_TEXTURE,
+        "sky": SKY_TEXTURE,
+        "spawn": [0.0, 0.0, -1.0, 0.0, 0.0, 0.66],
+        "walls": [],
+        "sprites": [],
+        "sectors": []
+    }
+    entries = {"floor": 1, "ceiling": 1, "sky": 1, "spawn": 6, "wall": 7, "sprite": 3, "sector": None}
+
+    with open(file_name) as f:
+        for number, line in enumerate(f, 1):
+            fields = line.split("#", 1)[0].split()
+            if len(fields) == 0:
+                continue
+
+            key = fields[0]
+            if key not in entries:
+                raise ValueError("%s:%d: unknown entry %s" % (file_name, number, key))
+            if entries[key] is None:
+                if len(fields) < 7 or len(fields) % 2 == 0:
+                    raise ValueError("%s:%d: %s takes 3 or more pairs of coordinates" % (file_name, number, key))
+            elif len(fields) - 1 != entries[key]:
+                raise ValueError("%s:%d: %s takes %d values" % (file_name, number, key, entries[key]))
+
+            try:
+                if key in ("floor", "ceiling", "sky"):
+                    level[key] = fields[1]
+                elif key == "spawn":
+                    level["spawn"] = [float(x) for x in fields[1:]]
+                elif key == "wall":
+                    level["walls"].append([float(x) for x in fields[1:7]] + [fields[7]])
+                elif key == "sector":
+                    values = [float(x) for x in fields[1:]]
+                    level["sectors"].append(zip(values[0::2], values[1::2]))
+                else:
+                    level["sprites"].append([float(x) for x in fields[1:3]] + [fields[3]])
+            except ValueError:
+                raise ValueError("%s:%d: invalid number in %s" % (file_name, number, key))
+
+    return level
+
+def compile_level(file_name):
+    # Compiles a level text file into the arrays the renderer uses, grid included.
+    # Returns the header describing the level and the arrays.
+    source = os.stat(file_name)
+    source_hash = level_source_hash(file_name)
+    level = parse_level(file_name)
+
+    # Collect every texture name once
+    textures = []
+    for entry in level["walls"] + level["sprites"]:
+        if entry[-1] not in textures:
+            textures.append(entry[-1])
+
+    num_walls = len(level["walls"])
+    walls = np.array([w[:6] for w in level["walls"]], dtype = np.float64).reshape(num_walls, 6)
+    a = np.ascontiguousarray(walls[:, 0:2])
+    b = np.ascontiguousarray(walls[:, 2:4])
+    v = b - a
+    norm = np.sqrt((v[:, 0] * v[:, 0]) + (v[:, 1] * v[:, 1]))
+    norm[norm == 0.0] = 1.0
+    n = np.empty((num_walls, 2))
+    n[:, 0] = -(v[:, 1] / norm)
+    n[:, 1] = v[:, 0] / norm
+    grid = WallGrid.from_arrays(a, b, n, walls[:, 4].copy(), walls[:, 5].copy(), None)
+
+    num_sprites = len(level["sprites"])
+    arrays = collections.OrderedDict([
+        ("wall_a", a),
+        ("wall_b", b),
+        ("wall_n", n),
+        ("wall_tca", grid.tca),
+        ("wall_tcb", grid.tcb),
+        ("wall_textures", np.array([textures.index(w[6]) for w in level["walls"]], dtype = np.int32)),
+        ("sprite_positions", np.array([sp[:2] for sp in level["sprites"]], dtype = np.float64).reshape(num_sprites, 2)),
+        ("sprite_textures", np.array([textures.index(sp[2]) for sp in level["sprites"]], dtype = np.int32))
+    ])
+    arrays.update(grid.get_grid())
+
+    # Group the walls and sprites by sector once when compiling
+    if len(level["sectors"]) > 0:
+        try:
+            sectors = SectorMap(level["sectors"])
+        except ValueError as e:
+            raise ValueError("%s: %s" % (file_name, e))
+        sectors.assign(a, b, arrays["sprite_positions"])
+        arrays.update(sectors.get_arrays())
+
+    header = {
+        "version": LEVEL_CACHE_VERSION,
+        "source_hash": source_hash,
+        "source_size": source.st_size,
+        "source_mtime": source.st_mtime,
+        "textures": textures,
+        "floor": level["floor"],
+        "ceiling": level["ceiling"],
+        "sky": level["sky"],
+        "spawn": level["spawn"]
+    }
+    return header, arrays
+
+def save_compiled_level(cache_name, header, arrays):
+    # Writes a compiled level into a binary file. The file starts with LEVEL_CACHE_MAGIC, the length of a JSON
+    # header and the header itself, followed by the arrays at the offsets listed in the header.
+    header = dict(header, arrays = {})
+
+    # Lay the arrays out after the header, aligned to 16 bytes. The offsets are relative to the end of the header
+    # so they don't change the header length.
+    offset = 0
+    for name, array in arrays.iteritems():
+        header["arrays"][name] = [offset, array.dtype.str, list(array.shape)]
+        offset += ((array.nbytes + 15) / 16) * 16
+    header = json.dumps(header)
+    header += " " * (-(len(LEVEL_CACHE_MAGIC) + 4 + len(header)) % 16)
+
+    # Write to a temporary file first so other instances never see a half written cache. A file that can't be
+    # written completely is removed.
+    temp_name = "%s.%d.tmp" % (cache_name, os.getpid())
+    try:
+        with open(temp_name, "wb") as f:
+            f.write(LEVEL_CACHE_MAGIC)
+            f.write(struct.pack("<I", len(header)))
+            f.write(header)
+            for array in arrays.itervalues():
+                data = np.ascontiguousarray(array).tostring()
+                f.write(data)
+                f.write("\0" * (-len(data) % 16))
+        os.rename(temp_name, cache_name)
+    except (IOError, OSError):
+        if os.path.exists(temp_name):
+            os.remove(temp_name)
+        raise
+
+def level_source_hash(file_name):
+    with open(file_name, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+def read_level_header(cache_name):
+    # Returns the header of a compiled level, or None if the file is missing or isn't a compiled level
+    try:
+        with open(cache_name, "rb") as f:
+            if f.read(len(LEVEL_CACHE_MAGIC)) != LEVEL_CACHE_MAGIC:
+                return None
+            length = struct.unpack("<I", f.read(4))[0]
+            header = json.loads(f.read(length))
+    except (IOError, struct.error, ValueError):
+        return None
+    return header if isinstance(header, dict) else None
+
+def map_compiled_level(cache_name):
+    # Returns the header of a compiled level and its arrays, which point into the memory mapped file.
+    # Returns None if the file is missing, isn't a compiled level or is too short for its arrays.
+    try:
+        with open(cache_name, "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+    except (IOError, ValueError, mmap.error):
+        return None
+
+    try:
+        if data[:len(LEVEL_CACHE_MAGIC)] != LEVEL_CACHE_MAGIC:
+            raise ValueError("not a compiled level")
+        length = struct.unpack("<I", data[len(LEVEL_CACHE_MAGIC):len(LEVEL_CACHE_MAGIC) + 4])[0]
+        start = len(LEVEL_CACHE_MAGIC) + 4 + length
+        header = json.loads(data[len(LEVEL_CACHE_MAGIC) + 4:start])
+        if not isinstance(header, dict) or not isinstance(header.get("arrays"), dict):
+            raise ValueError("not a compiled level header")
+        arrays = {}
+        for name, (offset, dtype, shape) in header["arrays"].iteritems():
+            count = int(np.prod(shape))
+            dtype = np.dtype(dtype)
+            if offset < 0 or count < 0 or start + offset + (count * dtype.itemsize) > len(data):
+                raise ValueError("array %s doesn't fit in the file" % name)
+            arrays[name] = np.frombuffer(data, dtype = dtype, count = count, offset = start + offset).reshape(shape)
+        return header, arrays
+    except (struct.error, ValueError, KeyError, TypeError):
+        data.close()
+        return None
+
+def level_scene(header, arrays):
+    # Builds the scene of a compiled level from its header and arrays. Returns the scene and the spawn pose.
+    # Textures are loaded opaque for the walls and with alpha for the sprites, each only if something uses it that way
+    wall_ids = set(arrays["wall_textures"])
+    textures = [TEXTURES.load(name) if k in wall_ids else None for k, name in enumerate(header["textures"])]
+    caster = WallGrid.from_arrays(arrays["wall_a"], arrays["wall_b"], arrays["wall_n"], arrays["wall_tca"], arrays["wall_tcb"],
+                                  [textures[k] for k in arrays["wall_textures"]], arrays)
+    sprite_ids = set(arrays["sprite_textures"])
+    sprites = SpriteSet.from_arrays(arrays["sprite_positions"], arrays["sprite_textures"],
+                                    [TEXTURES.load(name, alpha = True) if k in sprite_ids else None
+                                     for k, name in enumerate(header["textures"])])
+    sectors = SectorMap.from_arrays(arrays) if "sector_vertices" in arrays else None
+    scene = Scene(caster, Plane3d(header["floor"]), Plane3d(header["ceiling"]), Sky(header["sky"]), sprites, sectors)
+
+    spawn = header["spawn"]
+    return scene, (vec2(spawn[0], spawn[1]), vec2(spawn[2], spawn[3]), vec2(spawn[4], spawn[5]))
+
+def load_level(file_name):
+    # Loads a level, compiling it first when its binary cache is missing, can't be mapped or was compiled from
+    # another version of the file. Returns the scene and the spawn pose.
+    cache_name = file_name + LEVEL_CACHE_SUFFIX
+    header = read_level_header(cache_name)
+    stale = header is None or header.get("version") != LEVEL_CACHE_VERSION
+    if not stale:
+        # Hashing a big level costs more than mapping it, so the hash is only checked when the size or
+        # modification time changed
+        source = os.stat(file_name)
+        touched = header.get("source_size") != source.st_size or header.get("source_mtime") != source.st_mtime
+        if touched:
+            stale = header.get("source_hash") != level_source_hash(file_name)
+        compiled = map_compiled_level(cache_name) if not stale else None
+        if compiled is not None:
+            if touched:
+                # The file was only touched, like by a checkout. The cache is written again with the new size
+                # and time so later loads don't hash it again.
+                header, arrays = compiled
+                header["source_size"] = source.st_size
+                header["source_mtime"] = source.st_mtime
+                try:
+                    save_compiled_level(cache_name, header, arrays)
+                except (IOError, OSError):
+                    pass
+            return level_scene(*compiled)
+
+    header, arrays = compile_level(file_name)
+    try:
+        save_compiled_level(cache_name, header, arrays)
+    except (IOError, OSError):
+        # A level whose cache can't be written, like one in a read-only directory, is used from memory
+        return level_scene(header, arrays)
+    compiled = map_compiled_level(cache_name)
+    return level_scene(*compiled) if compiled is not None else level_scene(header, arrays)
+
+def sample_scene():
+    return load_level(LEVEL_FILE)[0]
+
+##############################################################
+# Dirty state tracker class
+##############################################################
+
+class DirtyTracker(object):
+    def __init__(self):
+        # Remembers what the last frame was rendered from to tell whether the next one is out of date
+        self.state = None
+        self.reused = 0
+
+    def invalidate(self):
+        self.state = None
+
+    def update(self, scene, player_pos, player_dir, plane, sky_enabled):
+        # Returns True if the frame must be rendered again, False if the previous one can be presented as it is
+        state = (id(scene), scene.version, player_pos.x, player_pos.y, player_dir.x, player_dir.y, plane.x, plane.y,
+                 sky_enabled)
+        changed = state != self.state
+        self.state = state
+        if not changed:
+            self.reused += 1
+        return changed
+
+##############################################################
+# Resolution scaler class
+##############################################################
+
+class ResolutionScaler(object):
+    def __init__(self, size = FB_SIZE, fps = FPS, scales = RESOLUTION_SCALES, window = RESOLUTION_WINDOW):
+        # Picks the frame buffer size from a fixed set of steps according to the recent frame times.
+        # It starts at the largest size.
+        self.sizes = sorted(set((max(int(size[0] * k), 1), max(int(size[1] * k), 1)) for k in scales))
+        self.level = len(self.sizes) - 1
+        self.budget = 1.0 / fps
+        self.times = collections.deque(maxlen = window)
+        self.changes = 0
+
+    @property
+    def size(self):
+        return self.sizes[self.level]
+
+    def update(self, frame_time):
+        # Records the time the last frame took and returns the size to render the next one at.
+        # The size only changes once the window is full again and the next step up must be expected to take
+        # well under the budget, so it doesn't go back and forth between two steps.
+        self.times.append(frame_time)
+        if len(self.times) < self.times.maxlen:
+            return self.size
+
+        mean = sum(self.times) / len(self.times)
+        w, h = self.size
+        if mean > self.budget * RESOLUTION_DOWN_LOAD and self.level > 0:
+            self.level -= 1
+        elif self.level + 1 < len(self.sizes):
+            up_w, up_h = self.sizes[self.level + 1]
+            if mean * (up_w * up_h) / float(w * h) >= self.budget * RESOLUTION_UP_LOAD:
+                return self.size
+            self.level += 1
+        else:
+            return self.size
+
+        self.times.clear()
+        self.changes += 1
+        return self.size
+
+##############################################################
+# Renderer class
+##############################################################
+
+class Renderer(object):
+    def __init__(self, size = FB_SIZE):
+        self.column_cache = ColumnCache()
+        self.profiler = Profiler()
+        self.tracker = DirtyTracker()
+        self.targets = {}
+        self.visible_key = None
+        self.visible = None
+        self.size = None
+        self.resize(size)
+
+    def resize(self, size):
+        # Switches to another frame buffer size. The frame buffer, projection tables and sky panorama of every
+        # size used are kept so going back to a size doesn't build them again.
+        if size == self.size:
+            return
+        if self.size is not None:
+            self.targets[self.size] = (self.frame_buffer, self.projection, self.sky_panorama)
+        self.frame_buffer, self.projection, self.sky_panorama = self.targets.pop(size, (pygame.Surface(size, pygame.HWSURFACE), None, None))
+        self.size = size
+        self.depth_buffer = np.zeros(size[0])
+        self.tracker.invalidate()
+
+    def invalidate(self):
+        # Forces the next frame to be rendered, for instance after drawing on top of the frame buffer
+        self.tracker.invalidate()
+
+    def get_projection(self, player_dir, plane):
+        # The projection tables are rebuilt only when the frame buffer size or the field of view change
+        fov = field_of_view(player_dir, plane)
+        if self.projection is None or not self.projection.matches(self.size, fov):
+            self.projection = Projection(self.size, fov)
+            self.profiler.count("projection_builds")
+        return self.projection
+
+    def get_visible_sectors(self, scene, player_pos, player_dir, plane):
+        # The sectors the whole frame can see are found once per camera and shared by the walls and the sprites
+        key = (scene, scene.version, self.size, player_pos.x, player_pos.y, player_dir.x, player_dir.y, plane.x, plane.y)
+        if key != self.visible_key:
+            self.visible = scene.visible_sectors(player_pos, player_dir, plane, self.size[0])
+            self.visible_key = key
+        return self.visible
+
+    def render(self, scene, player_pos, player_dir, plane, sky_enabled = False):
+        # Returns False if nothing changed since the last frame, which is then left in the frame buffer as it is
+        if not self.tracker.update(scene, player_pos, player_dir, plane, sky_enabled):
+            self.profiler.count("reused_frames")
+            return False
+
+        scales = self.column_cache.scales
+        self.render_world(scene, player_pos, player_dir, plane, sky_enabled)
+        self.render_sprites(scene, player_pos, player_dir, plane)
+        self.profiler.count("scales", self.column_cache.scales - scales)
+        return True
+
+    def render_world(self, scene, player_pos, player_dir, plane, sky_enabled = False, columns = None, hits = None):
+        # Renders the sky, walls, floor and ceiling of the given range of columns, all of them by default.
+        # The wall hits of the columns can be given already cast in hits, as returned by WallCaster.cast.
+        w, h_fb = self.size
+        x0, x1 = (0, w) if columns is None else columns
+
+        # Clear the screen
+        #self.frame_buffer.fill(FILL_COLOR)
+
+        profiler = self.profiler
+        blits = 0
+
+        # Render walls.
+        profiler.start("walls")
+        projection = self.get_projection(player_dir, plane)
+        self.depth_buffer = np.zeros(w)
+        p_angle = 360.0 - (math.atan2(player_dir.y, player_dir.x) * RAD2DEG)
+
+        # Generate the camera rays of every column and cast them against all walls at once
+        if hits is None:
+            ray_dirs = projection.ray_directions(player_dir, plane, x0, x1)
+            if columns is None:
+                sectors = self.get_visible_sectors(scene, player_pos, player_dir, plane)
+            else:
+                sectors = scene.visible_sectors(player_pos, player_dir, plane, w, x0, x1)
+            walls = scene.visible_walls(sectors)
+            hits = scene.caster.cast(player_pos, ray_dirs, walls)
+            profiler.count("intersections", scene.caster.tests)
+
+            if PARITY_CHECK:
+                mismatches = scene.caster.check_parity(player_pos, ray_dirs, walls)
+                if len(mismatches) > 0:
+                    raise RuntimeError("Wall caster parity check failed for columns " + str([x0 + m for m in mismatches]))
+
+        # Move the results to full width arrays
+        dists = np.zeros(w)
+        points = np.zeros((w, 2))
+        tex_coords = np.zeros(w)
+        indices = np.empty(w, dtype = np.intp)
+        indices.fill(-1)
+        dists[x0:x1], points[x0:x1], tex_coords[x0:x1], indices[x0:x1] = hits
+
+        # Compute the projected height of the walls in pixels where an intersection was found
+        hit = np.nonzero(indices >= 0)[0]
+        proj_dists = np.ones(w)
+        proj_dists[hit] = dists[hit] * projection.cos_angles[hit]
+        self.depth_buffer[hit] = dists[hit]
+
+        # The height tends to infinity as we get close to the walls so it must be clamped
+        heights = np.zeros(w, dtype = np.intp)
+        heights[hit] = np.minimum(h_fb / proj_dists[hit], HEIGHT_CLAMP_MULTIPLER * h_fb).astype(np.intp)
+        profiler.stop("walls")
+
+        # Render the sky behind the walls
+        if sky_enabled:
+            profiler.start("sky")
+            panorama = self.sky_panorama
+            if panorama is None or panorama.sky is not scene.sky or panorama.projection is not projection:
+                panorama = self.sky_panorama = SkyPanorama(scene.sky, projection)
+                profiler.count("panorama_builds")
+
+            # Only the rows above the lowest top of the walls can show the sky, walls and floor cover the rest.
+            # Columns without a wall show the whole sky.
+            tops = (h_fb / 2) - (heights[x0:x1] / 2)
+            rows = panorama.height if (indices[x0:x1] < 0).any() else int(tops.max())
+            if rows > 0:
+                blits += panorama.draw(self.frame_buffer, p_angle, x0, x1, rows)
+            profiler.stop("sky")
+
+        profiler.start("walls")
+
+        # Darken walls according to distance
+        shades = distance_shade(self.depth_buffer)
+
+        for i in np.nonzero(indices >= 0)[0]:
+            h = int(heights[i])
+            c = scene.caster.get_tex_column(indices[i], float(tex_coords[i]), h)
+            depth = int(shades[i])
+
+            # Walls shorter than the frame buffer are fully darkened so they can come darkened from the cache
+            preshaded = COLUMN_CACHE_PRESHADE and h < h_fb
+
+            # Then scale the corresponding texture slice and blit it
+            scaled = self.column_cache.get(c, h, depth if preshaded else None)
+            self.frame_buffer.blit(scaled, (i, -(h / 2) + (h_fb / 2)))
+            blits += 1
+
+            if not preshaded:
+                self.frame_buffer.fill((depth, depth, depth),
+                                       pygame.Rect(i,
+                                                   -(h / 2) + (h_fb / 2) if -(h / 2) + (h_fb / 2) >= 0 else 0,
+                                                   1, 
+                                                   scaled.get_height() if scaled.get_height() < h_fb else h_fb - 1),
+                                       pygame.BLEND_MULT)
+        profiler.stop("walls")
+
+        # Floor casting and ceiling casting
+        profiler.start("floor")
+        scene.floor_caster.render(self.frame_buffer, projection, player_pos, points, proj_dists, heights, not sky_enabled)
+        profiler.stop("floor")
+
+        profiler.count("blits", blits)
+
+    def render_sprites(self, scene, player_pos, player_dir, plane):
+        w, h_fb = self.size
+        profiler = self.profiler
+        sprites = scene.sprites
+
+        # Cull, project and sort all the sprites at once
+        profiler.start("sprite_sort")
+        candidates = scene.visible_sprites(self.get_visible_sectors(scene, player_pos, player_dir, plane))
+        indices, screen_x, sizes, depths = sprites.project(player_pos, player_dir, plane, self.size, candidates)
+        profiler.stop("sprite_sort")
+
+        # Render the sprites
+        profiler.start("sprites")
+        # The depth buffer holds the distance to the walls along each ray while the sprite depths are perpendicular
+        # to the camera plane, so the walls are brought to the camera plane too
+        depth_buffer = np.asarray(self.depth_buffer, dtype = np.float64) * self.get_projection(player_dir, plane).cos_angles
+        lefts = (-sizes // 2) + screen_x
+        starts = np.maximum(lefts, 0)
+        counts = np.minimum((sizes // 2) + screen_x, w) - starts
+
+        # Depth test every column of every sprite at once. The columns of each sprite that have no walls in
+        # front of them are split in runs of consecutive columns.
+        sprite = np.repeat(np.arange(len(indices)), counts)
+        cols = np.arange(len(sprite)) - np.repeat(np.cumsum(counts) - counts, counts) + starts[sprite]
+        runs = np.where(depths[sprite] < depth_buffer[cols], sprite, -1)
+        bounds = np.concatenate(([0], np.flatnonzero(runs[1:] != runs[:-1]) + 1, [len(runs)]))
+        bounds = np.column_stack((bounds[:-1], bounds[1:]))[runs[bounds[:-1]] >= 0] if len(runs) > 0 else bounds[:0]
+
+        # Darken the sprites according to distance
+        shades = distance_shade(depths)
+        draw_ys = np.maximum((-sizes // 2) + (h_fb / 2), 0)
+
+        blits = []
+        for r0, r1 in bounds.tolist():
+            k = sprite[r0]
+            texture = sprites.textures[sprites.texture_ids[indices[k]]]
+            sw = int(sizes[k])
+            shade = int(shades[k])
+            left = int(lefts[k])
+            y = int(draw_ys[k])
+            c0 = int(cols[r0])
+
+            if sw <= h_fb:
+                # Draw the run from the whole scaled sprite
+                image = self.column_cache.get_sprite(texture, sw, shade)
+                blits.append((image, (c0, y), pygame.Rect(c0 - left, 0, r1 - r0, sw)))
+            else:
+                # Sprites taller than the screen are drawn one column at a time so only the visible ones get scaled
+                for i in xrange(c0, c0 + r1 - r0):
+                    tc = ((i - left) * texture.width) / sw
+                    blits.append((self.column_cache.get(texture.get_column(tc), sw, shade), (i, y)))
+
+        # Blit the runs of every sprite in one call, keeping their back to front order
+        self.frame_buffer.blits(blits, False)
+        profiler.stop("sprites")
+
+        profiler.count("blits", len(blits))
+
+    def present(self, screen):
+        # Render framebuffer to the screen
+        pygame.transform.scale(self.frame_buffer, screen.get_size(), screen)
+        self.profiler.count("scales")
+
+##############################################################
+# Parallel Renderer class
+##############################################################
+
+# State of each render worker process, the scene is inherited from the parent process when the worker is forked
+worker_state = {}
+
+def init_render_worker(scene, size, pixels, depths, workers, barrier):
+    worker_state["scene"] = scene
+    worker_state["renderer"] = Renderer(size)
+    worker_state["pixels"] = pixels
+    worker_state["depths"] = depths
+    worker_state["workers"] = workers
+    worker_state["barrier"] = barrier
+
+def resize_render_worker(size):
+    # Switches the renderer of the worker to another size, then waits for every other worker to do the same.
+    # The barrier counts every worker that ever arrived, each round ends at the next multiple of the workers.
+    worker_state["renderer"].resize(size)
+    condition, arrived = worker_state["barrier"]
+    with condition:
+        arrived.value += 1
+        end = ((arrived.value + worker_state["workers"] - 1) / worker_state["workers"]) * worker_state["workers"]
+        condition.notify_all()
+        while arrived.value < end:
+            condition.wait()
+
+def shared_buffers(pixels, depths, size):
+    # Views of the first frame and depth buffer of the given size in the shared arrays
+    return (np.frombuffer(pixels, dtype = np.uint8, count = size[0] * size[1] * 3).reshape(size[0], size[1], 3),
+            np.frombuffer(depths, dtype = np.float64, count = size[0]))
+
+def render_strip(args):
+    # Renders a strip of columns and copies it to the shared frame and depth buffers.
+    # Returns the stage times and counters of the strip when profiling.
+    x0, x1, size, pos_x, pos_y, dir_x, dir_y, plane_x, plane_y, sky_enabled, profiling = args
+    renderer = worker_state["renderer"]
+    renderer.profiler.enabled = profiling
+    scales = renderer.column_cache.scales
+    renderer.render_world(worker_state["scene"], vec2(pos_x, pos_y), vec2(dir_x, dir_y), vec2(plane_x, plane_y),
+                          sky_enabled, (x0, x1))
+    renderer.profiler.count("scales", renderer.column_cache.scales - scales)
+    pixels, depths = shared_buffers(worker_state["pixels"], worker_state["depths"], size)
+    pixels[x0:x1] = pygame.surfarray.pixels3d(renderer.frame_buffer)[x0:x1]
+    depths[x0:x1] = renderer.depth_buffer[x0:x1]
+    return renderer.profiler.take_frame()
+
+class ParallelRenderer(Renderer):
+    def __init__(self, scene, size = FB_SIZE, workers = RENDER_WORKERS):
+        # The workers render the walls, floor and ceiling of the scene in strips of columns into shared buffers,
+        # the main process only copies the result, composites the sprites and presents.
+        # Changes made to the scene after creating the renderer are not seen by the workers.
+        # The shared buffers are as large as the initial size, the renderer can only be resized down from it.
+        self.scene = scene
+        self.workers = max(workers, 1)
+        self.max_size = size
+        self.pixels = multiprocessing.sharedctypes.RawArray(ctypes.c_uint8, size[0] * size[1] * 3)
+        self.depths = multiprocessing.sharedctypes.RawArray(ctypes.c_double, size[0])
+        self.pool = None
+        Renderer.__init__(self, size)
+        barrier = (multiprocessing.Condition(), multiprocessing.sharedctypes.RawValue(ctypes.c_int, 0))
+        self.pool = multiprocessing.Pool(self.workers, init_render_worker,
+                                         (scene, size, self.pixels, self.depths, self.workers, barrier))
+
+    def resize(self, size):
+        if size == self.size:
+            return
+        if size[0] > self.max_size[0] or size[1] > self.max_size[1]:
+            raise ValueError("A ParallelRenderer can't grow past the size it was created with")
+        Renderer.resize(self, size)
+        self.shared_pixels, self.depth_buffer = shared_buffers(self.pixels, self.depths, size)
+
+        # Split the columns in as many strips as workers
+        bounds = [(size[0] * k) / self.workers for k in xrange(self.workers + 1)]
+        self.strips = [(bounds[k], bounds[k + 1]) for k in xrange(self.workers) if bounds[k] < bounds[k + 1]]
+
+        # Resize every worker right away. None of them returns before all of them got a task, so each worker
+        # takes exactly one.
+        if self.pool is not None:
+            self.pool.map(resize_render_worker, [size] * self.workers, 1)
+
+    def render(self, scene, player_pos, player_dir, plane, sky_enabled = False):
+        if scene is not self.scene:
+            raise ValueError("A ParallelRenderer can only render the scene it was created with")
+
+        if not self.tracker.update(scene, player_pos, player_dir, plane, sky_enabled):
+            self.profiler.count("reused_frames")
+            return False
+
+        start = timeit.default_timer()
+        args = [(x0, x1, self.size, player_pos.x, player_pos.y, player_dir.x, player_dir.y, plane.x, plane.y, sky_enabled,
+                 self.profiler.enabled) for x0, x1 in self.strips]
+        results = self.pool.map(render_strip, args)
+        pygame.surfarray.blit_array(self.frame_buffer, self.shared_pixels)
+        self.add_strip_profiles(results, timeit.default_timer() - start)
+
+        scales = self.column_cache.scales
+        self.render_sprites(scene, player_pos, player_dir, plane)
+        self.profiler.count("scales", self.column_cache.scales - scales)
+        return True
+
+    def add_strip_profiles(self, results, elapsed):
+        # The strips are rendered side by side, so every stage takes as long as in the slowest strip while the
+        # counters add up. The strips stage is left with the rest of the elapsed time, spent handing out the
+        # strips and copying them back, so the stages still add up to the frame time.
+        if not self.profiler.enabled:
+            return
+        stages = collections.OrderedDict()
+        for times, counts in results:
+            for stage, t in times.iteritems():
+                stages[stage] = max(stages.get(stage, 0.0), t)
+            for counter, n in counts.iteritems():
+                self.profiler.count(counter, n)
+        self.profiler.add("strips", max(elapsed - sum(stages.itervalues()), 0.0))
+        for stage, t in stages.iteritems():
+            self.profiler.add(stage, t)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+##############################################################
+# Batch rendering
+##############################################################
+
+def init_headless(size = (1, 1)):
+    # Initializes Pygame without a window so scenes can be loaded and rendered with render_batch.
+    # Must be called before loading any texture.
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    pygame.init()
+    return pygame.display.set_mode(size)
+
+def pose_array(poses):
+    # Camera poses as an (n, 6) array of pos_x, pos_y, dir_x, dir_y, plane_x, plane_y.
+    # Takes either such an array or a list of (position, direction, plane) vec2 tuples.
+    if isinstance(poses, np.ndarray):
+        return np.asarray(poses, dtype = np.float64).reshape(-1, 6)
+    return np.array([(p.x, p.y, d.x, d.y, c.x, c.y) for p, d, c in poses], dtype = np.float64).reshape(-1, 6)
+
+def render_batch(scene, poses, size = FB_SIZE, sky_enabled = False, renderer = None):
+    # Renders the scene from every camera pose without a window. Returns an (n, height, width, 3) array of RGB
+    # frames and an (n, width) array with the distance to the wall seen by each column, 0 where there is none.
+    # Without sectors the wall hits of every camera are cast together. The frame buffer is cleared before each
+    # frame so every frame only depends on its pose.
+    poses = pose_array(poses)
+    renderer = Renderer(size) if renderer is None else renderer
+    renderer.resize(size)
+    w, h = size
+    n = len(poses)
+    frames = np.empty((n, h, w, 3), dtype = np.uint8)
+    depths = np.empty((n, w))
+    cameras = [(vec2(p[0], p[1]), vec2(p[2], p[3]), vec2(p[4], p[5])) for p in poses.tolist()]
+
+    # Cast the rays of all the cameras at once through the grid, each column keeps the origin of its camera.
+    # With sectors every camera is cast against the walls of its own visible sectors when it is rendered, since
+    # the walls all the cameras see together would be cast by brute force against every ray of the batch.
+    hits = None
+    if scene.sectors is None:
+        ray_dirs = np.empty((n * w, 2))
+        for k, (player_pos, player_dir, plane) in enumerate(cameras):
+            ray_dirs[k * w:(k + 1) * w] = renderer.get_projection(player_dir, plane).ray_directions(player_dir, plane, 0, w)
+        origins = vec2_array(np.repeat(poses[:, 0], w), np.repeat(poses[:, 1], w))
+        hits = scene.caster.cast(origins, ray_dirs)
+
+    for k, (player_pos, player_dir, plane) in enumerate(cameras):
+        columns = slice(k * w, (k + 1) * w)
+        renderer.frame_buffer.fill(FILL_COLOR)
+        renderer.render_world(scene, player_pos, player_dir, plane, sky_enabled,
+                              hits = tuple(a[columns] for a in hits) if hits is not None else None)
+        renderer.render_sprites(scene, player_pos, player_dir, plane)
+        frames[k] = pygame.surfarray.pixels3d(renderer.frame_buffer).swapaxes(0, 1)
+        depths[k] = renderer.depth_buffer
+
+    # The frame buffer no longer holds the last frame the renderer rendered through render
+    renderer.invalidate()
+    return frames, depths
+
+def init_batch_worker(scene, size):
+    worker_state["scene"] = scene
+    worker_state["renderer"] = Renderer(size)
+
+def render_batch_chunk(args):
+    poses, size, sky_enabled = args
+    return render_batch(worker_state["scene"], poses, size, sky_enabled, worker_state["renderer"])
+
+class BatchRenderer(object):
+    def __init__(self, scene, size = FB_SIZE, workers = RENDER_WORKERS, chunk = BATCH_CHUNK):
+        # Renders batches of poses with render_batch split in chunks of at most chunk poses over a pool of worker
+        # processes, or in this process if workers is 0. Like the ParallelRenderer, the workers get the scene when
+        # they are forked and don't see later changes to it.
+        self.scene = scene
+        self.size = size
+        self.workers = workers
+        self.chunk = chunk
+        self.renderer = Renderer(size) if workers == 0 else None
+        self.pool = multiprocessing.Pool(workers, init_batch_worker, (scene, size)) if workers > 0 else None
+
+    def render(self, poses, sky_enabled = False):
+        poses = pose_array(poses)
+        if self.pool is None:
+            return render_batch(self.scene, poses, self.size, sky_enabled, self.renderer)
+
+        # At least one chunk per worker so all of them get work
+        chunks = max(self.workers, (len(poses) + self.chunk - 1) / self.chunk)
+        results = self.pool.map(render_batch_chunk, [(c, self.size, sky_enabled) for c in np.array_split(poses, chunks)])
+        return np.concatenate([f for f, d in results]), np.concatenate([d for f, d in results])
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+
+##############################################################
+# Frame recorder class
+##############################################################
+
+def png_chunk(tag, data):
+    return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xffffffff)
+
+def encode_png(pixels, size, level = RECORD_PNG_LEVEL):
+    # Encodes RGB pixels as returned by pygame.image.tostring as a PNG file. It is done with zlib instead of
+    # pygame.image.save because zlib releases the GIL while it compresses and pygame doesn't.
+    w, h = size
+    rows = np.zeros((h, (w * 3) + 1), dtype = np.uint8) # Every row starts with filter type 0
+    rows[:, 1:] = np.frombuffer(pixels, dtype = np.uint8).reshape(h, w * 3)
+    return ("\x89PNG\r\n\x1a\n" + png_chunk("IHDR", struct.pack(">IIBBBBB", w, h, 8, 2, 0, 0, 0)) +
+            png_chunk("IDAT", zlib.compress(rows.tostring(), level)) + png_chunk("IEND", ""))
+
+class FrameRecorder(object):
+    def __init__(self, directory, size = FB_SIZE, format = RECORD_FORMAT, queue_size = RECORD_QUEUE_SIZE,
+                 drop = RECORD_DROP_FRAMES):
+        # Streams frames to a new numbered capture directory inside directory, either as a PNG sequence or as a
+        # single file of raw RGB frames. The render loop only copies the pixels out of the frame buffer, encoding
+        # and writing happen on a background thread. When its queue is full frames are dropped if drop is set,
+        # otherwise record waits for the writer to catch up.
+        if format not in ("png", "raw"):
+            raise ValueError("Unknown recording format " + format)
+        # Creating the directory is what claims its number, so instances recording at the same time never share one
+        number = 0
+        while True:
+            self.directory = os.path.join(directory, "capture%03d" % number)
+            try:
+                os.makedirs(self.directory)
+                break
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+                number += 1
+        self.size = tuple(size)
+        self.format = format
+        self.drop = drop
+        self.queue = Queue.Queue(queue_size)
+        self.recorded = 0
+        self.dropped = 0
+        self.written = 0
+        self.error = None
+        self.stream = open(os.path.join(self.directory, "frames.rgb"), "wb") if format == "raw" else None
+        self.thread = threading.Thread(target = self.write_frames)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def record(self, surface):
+        # Frames of another size, like those of the dynamic resolution, are scaled to the recording size
+        if surface.get_size() != self.size:
+            surface = pygame.transform.scale(surface, self.size)
+        frame = (self.recorded, pygame.image.tostring(surface, "RGB"))
+        self.recorded += 1
+        if not self.put(frame, not self.drop):
+            self.dropped += 1
+            return False
+        return True
+
+    def put(self, item, wait):
+        # Queues an item for the writer, waiting for room if wait is set. Returns False if the queue is full and
+        # wait isn't set, or if the writer stopped, in which case nothing would ever take the item.
+        while self.thread.is_alive():
+            try:
+                self.queue.put(item, wait, RECORD_POLL_TIME)
+                return True
+            except Queue.Full:
+                if not wait:
+                    return False
+        return False
+
+    def write_frames(self):
+        # Runs on the background thread until close queues None. A frame that can't be written stops the
+        # thread, the error is kept for close to report.
+        try:
+            while True:
+                frame = self.queue.get()
+                if frame is None:
+                    break
+                number, pixels = frame
+                if self.stream is not None:
+                    self.stream.write(pixels)
+                else:
+                    with open(os.path.join(self.directory, "frame%05d.png" % number), "wb") as f:
+                        f.write(encode_png(pixels, self.size))
+                self.written += 1
+        except (IOError, OSError) as e:
+            self.error = e
+
+    def stats(self):
+        return {
+            "directory": self.directory,
+            "format": self.format,
+            "size": list(self.size),
+            "fps": FPS,
+            "recorded": self.recorded,
+            "written": self.written,
+            "dropped": self.dropped,
+            "error": str(self.error) if self.error is not None else None
+        }
+
+    def close(self):
+        # Waits for the queued frames to be written and saves a description of the capture next to them.
+        # Dropped frames leave gaps in the PNG numbering and are missing from the raw stream.
+        # Raises the error that stopped the writer, after recording it in the description when possible.
+        self.put(None, True)
+        self.thread.join()
+        if self.stream is not None:
+            self.stream.close()
+        stats = self.stats()
+        try:
+            with open(os.path.join(self.directory, "capture.json"), "w") as f:
+                json.dump(stats, f, indent = 2, sort_keys = True)
+        except (IOError, OSError):
+            if self.error is None:
+                raise
+        if self.error is not None:
+            raise self.error
+        return stats
+
+def start_recording():
+    # Recording problems are reported without stopping the game
+    try:
+        return FrameRecorder(RECORD_DIR)
+    except (IOError, OSError) as e:
+        print "Can't record to %s: %s" % (RECORD_DIR, e)
+        return None
+
+def stop_recording(recorder):
+    try:
+        print "Recorded %(written)d frames to %(directory)s, %(dropped)d dropped" % recorder.close()
+    except (IOError, OSError) as e:
+        print "Recording to %s failed after %d frames: %s" % (recorder.directory, recorder.written, e)
 
 ##############################################################
 # Main Function
 ##############################################################
 
 def main():
-    global FOV, ANGLE_INCREMENT
-
     # Local variables.
     done = False
     toggle_sky = True
     sky_enabled = False
-    player_pos = vec2(0.0, 0.0)
-    player_dir = vec2(-1.0, 0.0)
-    plane = vec2(0.0, 0.66)
+    toggle_profiler = True
+    toggle_recording = True
+    exposed = True
     arrow_keys = {
         pygame.K_UP: False,
         pygame.K_DOWN: False, 
@@ -265,46 +2674,40 @@ def main():
         pygame.K_d: False
     }
 
-    # Update global variables
-    FOV = 2.0 * math.atan((plane.length() / player_dir.length())) * RAD2DEG
-    ANGLE_INCREMENT = FOV / float(FB_SIZE[0])
-
     # Initialize Pygame.
     pygame.init()
     clock = pygame.time.Clock()
     screen  = pygame.display.set_mode(SCREEN_SIZE, pygame.HWSURFACE | pygame.DOUBLEBUF)
-    frame_buffer = pygame.Surface(FB_SIZE, pygame.HWSURFACE)
     pygame.mouse.set_visible(False)
     pygame.key.set_repeat(17, 17)
 
-    # Define walls, floor and ceiling.
-    walls = [
-        LineSegment(vec2(3.0, 3.0), vec2(3.0, -3.0), 0.0, 6.0, "Textures/metal.jpg"),
-        LineSegment(vec2(3.0, -3.0), vec2(-3.0, -3.0), 0.0, 6.0, "Textures/metal.jpg"),
-        LineSegment(vec2(-3.0, -3.0), vec2(-3.0, 3.0), 0.0, 6.0, "Textures/metal.jpg"),
-        LineSegment(vec2(2.0, 2.0), vec2(3.0, 3.0), 0.0, 1.0, "Textures/diagmetal.jpg"),
-        LineSegment(vec2(-2.0, 2.0), vec2(-3.0, 3.0), 0.0, 1.0, "Textures/diagmetal.jpg"),
-        LineSegment(vec2(-2.0, 2.0), vec2(2.0, 2.0), 0.0, 4.0, "Textures/diagmetal.jpg"),
-        LineSegment(vec2(-0.5, -1.0), vec2(-1.5, -3.0), vec2(-1.5, -3.0).sub(vec2(-0.5, -1.0)).length(), 0.0, "Textures/orangetiles.jpg"),
-        LineSegment(vec2(-0.5, -1.0), vec2(0.5, -1.0), 0.0, 1.0, "Textures/orangetiles.jpg"),
-        LineSegment(vec2(0.5, -1.0), vec2(1.5, -3.0), vec2(1.5, -3.0).sub(vec2(0.5, -1.0)).length(), 0.0, "Textures/orangetiles.jpg")
-    ]
-    floor = Plane3d(FLOOR_TEXTURE)
-    ceiln = Plane3d(CEIL_TEXTURE)
-    sky = Sky(SKY_TEXTURE)
-    sprites = [
-        Sprite(vec2(-1.5, -2.0), "Textures/bag.png"),
-        Sprite(vec2(1.5, -2.0), "Textures/bag.png")
-    ]
+    # Load the level
+    scene, (player_pos, player_dir, plane) = load_level(LEVEL_FILE)
+    perp = vec2(0.0, 0.0)
+    renderer = ParallelRenderer(scene, FB_SIZE, RENDER_WORKERS) if RENDER_WORKERS > 0 else Renderer(FB_SIZE)
+    profiler = renderer.profiler
+    scaler = ResolutionScaler(FB_SIZE, FPS) if DYNAMIC_RESOLUTION else None
+
+    # Load the textures around the spawn while the first frames render, after the render workers were forked
+    TEXTURES.prefetch(scene.textures_near(player_pos, TEXTURE_PREFETCH_RADIUS))
+    recorder = start_recording() if RECORDING else None
 
     # Main game loop.
     try:
         while(not done):
             fps = clock.get_fps() + 0.001
-            pygame.display.set_caption(TITLE + ": " + str(int(fps)))
-            
+            if scaler is not None:
+                pygame.display.set_caption(TITLE + ": " + str(int(fps)) + " @ %dx%d" % renderer.size)
+            else:
+                pygame.display.set_caption(TITLE + ": " + str(int(fps)))
+            frame_start = timeit.default_timer()
+            profiler.start("input")
+
             # Input capture.
             for event in pygame.event.get():
+                if event.type == pygame.VIDEOEXPOSE:
+                    exposed = True
+
                 # Quit on escape key or window close
                 if (event.type == pygame.KEYDOWN and event.key == pygame.K_ESCAPE) or event.type == pygame.QUIT:
                     done = True
@@ -316,6 +2719,31 @@ def main():
                 elif event.type == pygame.KEYUP and event.key == pygame.K_SPACE and not toggle_sky:
                     toggle_sky = True
 
+                # Toggle the profiler overlay with tab and dump its statistics with P
+                if event.type == pygame.KEYDOWN and event.key == pygame.K_TAB and toggle_profiler:
+                    toggle_profiler = False
+                    profiler.enabled = not profiler.enabled
+                    profiler.reset()
+                    renderer.invalidate()
+
+                elif event.type == pygame.KEYUP and event.key == pygame.K_TAB and not toggle_profiler:
+                    toggle_profiler = True
+
+                if event.type == pygame.KEYDOWN and event.key == pygame.K_p and profiler.enabled:
+                    profiler.dump()
+
+                # Start and stop recording with R
+                if event.type == pygame.KEYDOWN and event.key == pygame.K_r and toggle_recording:
+                    toggle_recording = False
+                    if recorder is None:
+                        recorder = start_recording()
+                    else:
+                        stop_recording(recorder)
+                        recorder = None
+
+                elif event.type == pygame.KEYUP and event.key == pygame.K_r and not toggle_recording:
+                    toggle_recording = True
+
                 # Record wich keys were pressed and released this frame
                 try:
                     if event.type == pygame.KEYDOWN:
@@ -325,193 +2753,74 @@ def main():
                 except KeyError:
                     pass
             
-            # Camera movement
+            # Camera movement, the camera vectors are updated in place
             if arrow_keys[pygame.K_UP] or arrow_keys[pygame.K_w]:
-                player_pos = player_pos.add(player_dir.scale(PLAYER_MOVE_SPEED))
+                player_pos.iadd_scaled(player_dir, PLAYER_MOVE_SPEED)
 
             if arrow_keys[pygame.K_DOWN] or arrow_keys[pygame.K_s]:
-                player_pos = player_pos.sub(player_dir.scale(PLAYER_MOVE_SPEED))
+                player_pos.iadd_scaled(player_dir, -PLAYER_MOVE_SPEED)
 
             if arrow_keys[pygame.K_a]:
-                perp = vec2(-player_dir.y, player_dir.x).normalize()
-                player_pos = player_pos.add(perp.scale(PLAYER_MOVE_SPEED))
+                perp.set(-player_dir.y, player_dir.x).inormalize()
+                player_pos.iadd_scaled(perp, PLAYER_MOVE_SPEED)
 
             if arrow_keys[pygame.K_d]:
-                perp = vec2(player_dir.y, -player_dir.x).normalize()
-                player_pos = player_pos.add(perp.scale(PLAYER_MOVE_SPEED))
+                perp.set(player_dir.y, -player_dir.x).inormalize()
+                player_pos.iadd_scaled(perp, PLAYER_MOVE_SPEED)
 
             if arrow_keys[pygame.K_LEFT]:
                 # Apply a rotation matrix to the view and projection vectors
-                oldDirX = player_dir.x;
-                player_dir.x = player_dir.x * math.cos(PLAYER_TURN_SPEED) - player_dir.y * math.sin(PLAYER_TURN_SPEED);
-                player_dir.y = oldDirX * math.sin(PLAYER_TURN_SPEED) + player_dir.y * math.cos(PLAYER_TURN_SPEED);
-                oldPlaneX = plane.x;
-                plane.x = plane.x * math.cos(PLAYER_TURN_SPEED) - plane.y * math.sin(PLAYER_TURN_SPEED);
-                plane.y = oldPlaneX * math.sin(PLAYER_TURN_SPEED) + plane.y * math.cos(PLAYER_TURN_SPEED);
+                player_dir.irotate(math.cos(PLAYER_TURN_SPEED), math.sin(PLAYER_TURN_SPEED))
+                plane.irotate(math.cos(PLAYER_TURN_SPEED), math.sin(PLAYER_TURN_SPEED))
 
             if arrow_keys[pygame.K_RIGHT]:
                 # Apply a rotation matrix to the view and projection vectors
-                oldDirX = player_dir.x;
-                player_dir.x = player_dir.x * math.cos(-PLAYER_TURN_SPEED) - player_dir.y * math.sin(-PLAYER_TURN_SPEED);
-                player_dir.y = oldDirX * math.sin(-PLAYER_TURN_SPEED) + player_dir.y * math.cos(-PLAYER_TURN_SPEED);
-                oldPlaneX = plane.x;
-                plane.x = plane.x * math.cos(-PLAYER_TURN_SPEED) - plane.y * math.sin(-PLAYER_TURN_SPEED);
-                plane.y = oldPlaneX * math.sin(-PLAYER_TURN_SPEED) + plane.y * math.cos(-PLAYER_TURN_SPEED);
-
-            # Clear the screen
-            #frame_buffer.fill(FILL_COLOR)
-
-            # Render walls.
-            angle = -FOV / 2.0
-            depth_buffer = [0 for x in xrange(FB_SIZE[0])]
-            p_angle = 360.0 - (math.atan2(player_dir.y, player_dir.x) * RAD2DEG)
-            for i in xrange(FB_SIZE[0]):
-                if sky_enabled and h < FB_SIZE[1]:
-                    sky_angle = (p_angle + angle) % 360.0
-                    sky_angle = 360.0 - sky_angle if sky_angle < 0.0 else sky_angle
-                    stex = sky.sample_texture(sky_angle)
-                    frame_buffer.blit(stex, (i, 0))
-
-                # Generate camera ray
-                camera_x = 2.0 * (float(i) / float(FB_SIZE[0])) - 1;
-                r = Ray(vec2(player_pos.x, player_pos.y), player_dir.add(plane.scale(camera_x)))
-
-                d = float('Inf')
-                c = None
-                p = None
-                h = 0
-                # Check each wall for an intersection
-                for l in walls:
-                    intersection = l.intersect(r)
-                    if intersection is not None:
-                        # If an intersection was found then keep it if it's closer than the previous one
-                        if intersection.d < d:
-                            d = intersection.d
-                            c = l.get_tex_column(intersection.tc)
-                            p = intersection.p
-                            depth_buffer[i] = d
-
-                if c is not None:
-                    # If an intersection was found then compute the projected height of the wall in pixels
-                    h = int(float(FB_SIZE[1]) / (d * math.cos(angle * DEG2RAD)))
-
-                    # The height tends to infinity as we get close to the walls so it must be clamped
-                    h = HEIGHT_CLAMP_MULTIPLER * FB_SIZE[1] if h > HEIGHT_CLAMP_MULTIPLER * FB_SIZE[1] else h
-
-                    # Then scale the corresponding texture slice and blit it
-                    scaled = pygame.transform.scale(c, (c.get_width(), h))
-                    frame_buffer.blit(scaled, (i, -(h / 2) + (FB_SIZE[1] / 2)))
-
-                    # Darken wall according to distance
-                    _d = (d if d < FAR else FAR) / FAR
-                    depth = 255 - int(_d * 255)
-                    frame_buffer.fill((depth, depth, depth),
-                                      pygame.Rect(i,
-                                                  -(h / 2) + (FB_SIZE[1] / 2) if -(h / 2) + (FB_SIZE[1] / 2) >= 0 else 0,
-                                                  1, 
-                                                  scaled.get_height() if scaled.get_height() < FB_SIZE[1] else FB_SIZE[1] - 1),
-                                      pygame.BLEND_MULT)
-
-                # Floor casting and ceiling casting
-                if p is not None and h > 0 and h < FB_SIZE[1]:
-                    for j in xrange((h / 2) + (FB_SIZE[1] / 2), FB_SIZE[1] + 1):
-                        det = (2.0 * j - FB_SIZE[1])
-                        if det > 0.0:
-                            cd = FB_SIZE[1] / det
-                            weight = cd / (d * math.cos(angle * DEG2RAD))
-                            st = vec2((weight * p.x) + ((1.0 - weight) * player_pos.x), (weight * p.y) + ((1.0 - weight) * player_pos.y))
-
-                            # Sample floor
-                            ftex = floor.sample_texture(st)
-
-                            # Draw floor
-                            frame_buffer.blit(floor.texture, (i, j), ftex)
-
-                            # Darken floor according to distance
-                            _d = (cd if cd < FAR else FAR) / FAR
-                            depth = 255 - int(_d * 255)
-                            frame_buffer.fill((depth, depth, depth), pygame.Rect(i, j, 1, 1), pygame.BLEND_MULT)
-
-                            # Draw ceiling
-                            if not sky_enabled:
-                                ctex = ceiln.sample_texture(st)
-                                frame_buffer.blit(ceiln.texture, (i, FB_SIZE[1] - j), ctex)
-                                frame_buffer.fill((depth, depth, depth), pygame.Rect(i, FB_SIZE[1] - j, 1, 1), pygame.BLEND_MULT)
-
-                angle += ANGLE_INCREMENT
-            
-            # Sort the sprites by distance
-            for s in sprites:
-                s.d = player_pos.distanceSQ(s.p)
-            sprites.sort(key = lambda s: s.d, reverse = True)
-    
-            # Render the sprites
-            for s in sprites:
-                # Take sprite to eye space
-                sp_eye = s.p.sub(player_pos)
-
-                # Apply inverse camera matrix to sp_eye
-                inv_det = 1.0 / ((plane.x * player_dir.y) - (player_dir.x * plane.y))
-                tx = inv_det * ((player_dir.y * sp_eye.x) - (player_dir.x * sp_eye.y))
-                ty = inv_det * ((-plane.y * sp_eye.x) + (plane.x * sp_eye.y))
-
-                # If the sprite is behind the eye there is no need to continue with this sprite
-                if ty <= 0.0:
-                    continue
-
-                # Compute sprite x position in image space, width and height
-                sp_screen_x = int((FB_SIZE[0] / 2) * (1.0 + (tx / ty)))
-                sh = int(abs(FB_SIZE[1] / ty))
-                sw = sh # The sprites are always square
-
-                # Compute draw rows
-                draw_start_y = int((-sh / 2) + (FB_SIZE[1] / 2))
-                draw_start_y = 0 if draw_start_y < 0 else draw_start_y
-                draw_end_y = int((sh / 2) + (FB_SIZE[1] / 2))
-                draw_end_y = FB_SIZE[1] - 1 if draw_end_y >= FB_SIZE[1] else draw_end_y
-
-                # Compute draw cols
-                draw_start_x = int((-sw / 2) + sp_screen_x)
-                draw_start_x = 0 if draw_start_x < 0 else draw_start_x
-                draw_end_x = int((sw / 2) + sp_screen_x)
-                draw_end_x = FB_SIZE[0] if draw_end_x >= FB_SIZE[0] else draw_end_x
-
-                # Draw columns
-                tw = s.texture.get_width()
-                for i in xrange(draw_start_x, draw_end_x):
-                    # Compute tex coord of sprite slice
-                    tc = int((i - (-sw / 2 + sp_screen_x)) * tw / sw)
-
-                    # Draw only if the sprite slice is actually inside the screen and there are no walls in front of it
-                    if i >= 0 and i < FB_SIZE[0] and ty < depth_buffer[i]:
-                        # Get texture slice and scale it to it's on-screen height
-                        c = s.sample_texture(tc)
-                        scaled = pygame.transform.scale(c, (c.get_width(), sh))
-
-                        # Darken the texture by distance
-                        _d = (ty if ty < FAR else FAR) / FAR
-                        depth = 255 - int(_d * 255)
-                        scaled.fill((depth, depth, depth, 1.0),
-                                    pygame.Rect(0,
-                                                0,
-                                                1, 
-                                                sh),
-                                    pygame.BLEND_MULT
-                        )
-                        
-                        # Draw the sprite
-                        frame_buffer.blit(scaled, (i, draw_start_y))
-
-            # Render framebuffer to the screen
-            pygame.transform.scale(frame_buffer, SCREEN_SIZE, screen)
-
-            # Update screen
-            pygame.display.update()
+                player_dir.irotate(math.cos(-PLAYER_TURN_SPEED), math.sin(-PLAYER_TURN_SPEED))
+                plane.irotate(math.cos(-PLAYER_TURN_SPEED), math.sin(-PLAYER_TURN_SPEED))
+
+            profiler.stop("input")
+
+            # Render the frame and scale it to the screen. The overlay is drawn on the frame buffer so the frame
+            # can't be reused while the profiler is enabled.
+            if profiler.enabled:
+                renderer.invalidate()
+            rendered = renderer.render(scene, player_pos, player_dir, plane, sky_enabled)
+
+            # Frames are recorded without the overlay, reused ones too so the capture keeps the frame rate
+            if recorder is not None:
+                profiler.start("record")
+                recorder.record(renderer.frame_buffer)
+                profiler.stop("record")
+                if recorder.error is not None:
+                    stop_recording(recorder)
+                    recorder = None
+            if profiler.enabled:
+                profiler.draw(renderer.frame_buffer)
+
+            # Update screen only if the frame changed or the window needs to be redrawn
+            if rendered or exposed:
+                profiler.start("present")
+                renderer.present(screen)
+                pygame.display.update()
+                profiler.stop("present")
+                exposed = False
+
+            # Pick the frame buffer size of the next frame from the time this one took, without the wait for the
+            # next tick. Reused frames say nothing about the cost of rendering.
+            if scaler is not None and rendered:
+                renderer.resize(scaler.update(timeit.default_timer() - frame_start))
+            profiler.end_frame()
             clock.tick(FPS)
             
     except KeyboardInterrupt:
         pass
 
+    if RENDER_WORKERS > 0:
+        renderer.close()
+
+    if recorder is not None:
+        stop_recording(recorder)
+
     pygame.quit()
 
 if __name__ == "__main__":
@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import shutil
+import tempfile
+
+os.environ["SDL_VIDEODRIVER"] = "dummy"
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import py_caster
+
+##############################################################
+# Headless test setup shared by the test modules
+##############################################################
+
+def set_up(state):
+    # Starts Pygame without a window from the root of the repository, which the texture paths of the levels
+    # are relative to. The textures are cached in a temporary directory so the texture cache isn't written
+    # into the source tree.
+    state["cwd"] = os.getcwd()
+    state["texture_cache_dir"] = py_caster.TEXTURE_CACHE_DIR
+    state["temp_dir"] = tempfile.mkdtemp(prefix = "pycaster-test-")
+    os.chdir(ROOT)
+    py_caster.TEXTURE_CACHE_DIR = os.path.join(state["temp_dir"], "textures")
+    py_caster.init_headless()
+
+def tear_down(state):
+    py_caster.TEXTURES.clear()
+    py_caster.TEXTURE_CACHE_DIR = state["texture_cache_dir"]
+    os.chdir(state["cwd"])
+    shutil.rmtree(state["temp_dir"], ignore_errors = True)
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import random
+import unittest
+
+os.environ["SDL_VIDEODRIVER"] = "dummy"
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import numpy as np
+import pygame
+import benchmark
+import headless
+import py_caster
+
+##############################################################
+# Batch parameters
+##############################################################
+
+ROOMS      = 4        # Rooms per side of the map of rooms
+BATCH_SIZE = 32
+MATCH_SIZE = 200      # Cameras compared with and without sectors, enough for some to see sprites right behind walls
+MATCH_SEED = 2
+PARALLEL_WORKERS = 3
+FB_SIZE    = (80, 50)
+
+def random_poses(count, seed = 0):
+    # Cameras anywhere in the map of rooms looking anywhere
+    rng = random.Random(seed)
+    extent = ROOMS * benchmark.ROOM_SIZE
+    return [benchmark.pose(rng.uniform(0.1, extent - 0.1), rng.uniform(0.1, extent - 0.1), rng.uniform(0.0, 6.28))
+            for k in xrange(count)]
+
+##############################################################
+# Setup
+##############################################################
+
+state = {}
+
+def setUpModule():
+    headless.set_up(state)
+
+def tearDownModule():
+    headless.tear_down(state)
+
+##############################################################
+# Tests
+##############################################################
+
+class SectorBatchTest(unittest.TestCase):
+    def setUp(self):
+        self.scene, center = benchmark.rooms_scene(ROOMS)
+        self.poses = random_poses(BATCH_SIZE)
+
+    def test_cast_size_is_bounded(self):
+        # Every cast of a batch over a map with sectors takes the rays of a single camera, and casts by brute
+        # force take at most as many walls as a visible set can hold, however many cameras the batch has
+        casts = []
+        cast = self.scene.caster.cast
+        def record(origin, directions, walls = None):
+            casts.append((len(directions), len(walls) if walls is not None else 0))
+            return cast(origin, directions, walls)
+        self.scene.caster.cast = record
+
+        py_caster.render_batch(self.scene, self.poses, FB_SIZE)
+        self.assertEqual(len(casts), BATCH_SIZE)
+        self.assertLessEqual(max(rays for rays, walls in casts), FB_SIZE[0])
+        self.assertLessEqual(max(rays * walls for rays, walls in casts), FB_SIZE[0] * py_caster.SECTOR_MAX_WALLS)
+
+    def test_matches_map_without_sectors(self):
+        # The walls and sprites seen from every camera are the same with and without sectors
+        flat, center = benchmark.rooms_scene(ROOMS, with_sectors = False)
+        poses = random_poses(MATCH_SIZE, MATCH_SEED)
+        frames, depths = py_caster.render_batch(self.scene, poses, FB_SIZE)
+        flat_frames, flat_depths = py_caster.render_batch(flat, poses, FB_SIZE)
+        self.assertTrue(np.array_equal(depths, flat_depths))
+        self.assertTrue(np.array_equal(frames, flat_frames))
+
+class ParallelRendererTest(unittest.TestCase):
+    def setUp(self):
+        self.poses = random_poses(BATCH_SIZE)
+
+    def test_matches_renderer_after_resize(self):
+        # Every worker follows the renderer to a smaller size and back
+        scene, center = benchmark.rooms_scene(ROOMS)
+        renderer = py_caster.ParallelRenderer(scene, FB_SIZE, PARALLEL_WORKERS)
+        try:
+            for size in (FB_SIZE, (FB_SIZE[0] / 2, FB_SIZE[1] / 2), FB_SIZE):
+                renderer.resize(size)
+                serial = py_caster.Renderer(size)
+                for position, direction, plane in self.poses[:4]:
+                    renderer.render(scene, position, direction, plane)
+                    serial.render(scene, position, direction, plane)
+                    self.assertTrue(np.array_equal(pygame.surfarray.array3d(renderer.frame_buffer),
+                                                   pygame.surfarray.array3d(serial.frame_buffer)))
+        finally:
+            renderer.close()
+
+if __name__ == "__main__":
+    unittest.main()
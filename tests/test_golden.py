@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import math
+import json
+import struct
+import timeit
+import shutil
+import tempfile
+import unittest
+
+os.environ["SDL_VIDEODRIVER"] = "dummy"
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import numpy as np
+import pygame
+import headless
+import py_caster
+
+##############################################################
+# Golden image parameters
+##############################################################
+
+GOLDEN_DIR       = os.path.join(ROOT, "tests", "golden")
+BASELINE_FILE    = os.path.join(GOLDEN_DIR, "baseline.json")
+PIXEL_TOLERANCE  = 2     # Largest difference allowed in any channel of a pixel
+PIXEL_BUDGET     = 0.001 # Fraction of the pixels allowed to differ by more than PIXEL_TOLERANCE
+TIMING_RUNS      = 15    # Renders timed per pose, each after a run of the calibration workload
+TIMING_TOLERANCE = 2.0   # A pose fails when its time relative to the calibration workload doubles
+SKIP_TIMING      = os.environ.get("PYCASTER_SKIP_TIMING", "") not in ("", "0")
+
+def pose(x, y, angle, fov_scale = 0.66):
+    d = py_caster.vec2(math.cos(angle), math.sin(angle))
+    return py_caster.vec2(x, y), d, py_caster.vec2(d.y * fov_scale, -d.x * fov_scale)
+
+# Every pose looks at something that is easy to break while optimizing the renderer. Each entry is the name of
+# its golden image, the pose (None for the spawn point of the level) and whether the sky is drawn.
+POSES = [
+    ("spawn",    None,                                        False), # The default view
+    ("fisheye",  pose(1.0, -0.5, 0.0),                        False), # A long wall seen at an angle stays straight
+    ("clamp",    pose(2.97, 0.4, 0.0),                        False), # Walls closer than the HEIGHT_CLAMP_MULTIPLER clamp
+    ("wrap",     pose(0.0, 1.0, -math.pi / 2),                False), # Texture coordinates wrapping along a wall
+    ("sprites",  pose(0.9, 1.0, math.atan2(-3.0, -2.2)),      False), # A sprite half hidden behind a wall
+    ("sky",      pose(0.0, -0.8, math.pi / 2 + 0.3),          True),  # The sky above walls of different heights
+    ("distance", pose(-2.7, -2.7, math.pi / 4),               False), # Far walls sampled from small mipmaps
+]
+
+##############################################################
+# Helpers
+##############################################################
+
+def load_scene():
+    # Loads the copy of the sample level with an empty texture manager, so the textures come from the texture
+    # cache if it was filled before
+    py_caster.TEXTURES.clear()
+    return py_caster.load_level(state["level_file"])
+
+def render_pose(scene, spawn, entry, renderer = None):
+    # Renders one pose with a new renderer, the frame buffer isn't cleared between frames
+    name, p, sky = entry
+    position, direction, plane = spawn if p is None else p
+    renderer = py_caster.Renderer(py_caster.FB_SIZE) if renderer is None else renderer
+    renderer.render(scene, position, direction, plane, sky)
+    return renderer
+
+def frame_pixels(surface):
+    return pygame.surfarray.array3d(surface).astype(np.int16)
+
+calibration = {}
+
+def calibration_workload():
+    # A fixed mix of the kinds of work a frame does, Python arithmetic, NumPy array math and Pygame column
+    # scaling and blitting, that doesn't depend on the renderer. Render times are measured relative to it so
+    # the baseline holds on other machines and under load.
+    if len(calibration) == 0:
+        calibration["column"] = pygame.Surface((64, 64)).subsurface((0, 0, 1, 64))
+        calibration["target"] = pygame.Surface(py_caster.FB_SIZE)
+        calibration["x"] = np.linspace(0.1, 10.0, py_caster.FB_SIZE[0])
+    x = calibration["x"]
+    for i in xrange(80):
+        y = np.sqrt((x * x) + 1.0) / (x + 0.5)
+        y = np.where(y > 1.0, y, 1.0 / y)[np.argsort(x * y)]
+    total = 0.0
+    for i in xrange(8000):
+        total += math.sqrt((i * 0.5) + (total * 0.001))
+    column = calibration["column"]
+    blit = calibration["target"].blit
+    for i in xrange(4 * py_caster.FB_SIZE[0]):
+        blit(pygame.transform.scale(column, (1, 40 + (i % 160))), (i % py_caster.FB_SIZE[0], 0))
+
+def time_pose(scene, spawn, entry):
+    # Shortest milliseconds of rendering the pose again once its textures and columns are loaded, and of the
+    # calibration workload run before every render. The shortest times are the least disturbed by other work.
+    renderer = render_pose(scene, spawn, entry)
+    calibration_workload()
+    pose_times = []
+    reference_times = []
+    for i in xrange(TIMING_RUNS):
+        start = timeit.default_timer()
+        calibration_workload()
+        reference_times.append((timeit.default_timer() - start) * 1000.0)
+
+        renderer.invalidate()
+        start = timeit.default_timer()
+        render_pose(scene, spawn, entry, renderer)
+        pose_times.append((timeit.default_timer() - start) * 1000.0)
+    return min(pose_times), min(reference_times)
+
+def per_pixel_floor(frame_buffer, scene, player_pos, points, proj_dists, heights, columns):
+    # The floor and ceiling casting loop FloorCaster replaced, one blit and one BLEND_MULT fill per pixel
+    h_fb = frame_buffer.get_height()
+    for i in columns:
+        h = int(heights[i])
+        if h <= 0 or h >= h_fb:
+            continue
+        for j in xrange((h / 2) + (h_fb / 2), h_fb + 1):
+            det = (2.0 * j - h_fb)
+            if det > 0.0:
+                cd = h_fb / det
+                weight = cd / proj_dists[i]
+                st = py_caster.vec2((weight * points[i, 0]) + ((1.0 - weight) * player_pos.x),
+                                    (weight * points[i, 1]) + ((1.0 - weight) * player_pos.y))
+                _d = (cd if cd < py_caster.FAR else py_caster.FAR) / py_caster.FAR
+                depth = 255 - int(_d * 255)
+                frame_buffer.blit(scene.floor.texture.surface, (i, j), scene.floor.sample_texture(st))
+                frame_buffer.fill((depth, depth, depth), pygame.Rect(i, j, 1, 1), pygame.BLEND_MULT)
+                frame_buffer.blit(scene.ceiling.texture.surface, (i, h_fb - j), scene.ceiling.sample_texture(st))
+                frame_buffer.fill((depth, depth, depth), pygame.Rect(i, h_fb - j, 1, 1), pygame.BLEND_MULT)
+
+def golden_name(name):
+    return os.path.join(GOLDEN_DIR, name + ".png")
+
+def load_baseline():
+    with open(BASELINE_FILE) as f:
+        return json.load(f)
+
+def update_goldens():
+    # Renders every pose again and stores the frames and render times as the new references
+    scene, spawn = load_scene()
+    if not os.path.isdir(GOLDEN_DIR):
+        os.makedirs(GOLDEN_DIR)
+    # The render times are stored relative to the calibration workload, the milliseconds are only informative
+    baseline = {"fb_size": list(py_caster.FB_SIZE), "poses": {}, "poses_ms": {}, "reference_ms": {}}
+    for entry in POSES:
+        pygame.image.save(render_pose(scene, spawn, entry).frame_buffer, golden_name(entry[0]))
+        measured, reference = time_pose(scene, spawn, entry)
+        baseline["poses"][entry[0]] = round(measured / reference, 4)
+        baseline["poses_ms"][entry[0]] = round(measured, 3)
+        baseline["reference_ms"][entry[0]] = round(reference, 3)
+        print "%-10s %8.3f ms %8.3f ms calibration %6.3f" % (entry[0], measured, reference, measured / reference)
+    with open(BASELINE_FILE, "w") as f:
+        json.dump(baseline, f, indent = 2, separators = (",", ": "), sort_keys = True)
+        f.write("\n")
+
+##############################################################
+# Setup
+##############################################################
+
+state = {}
+
+def setUpModule():
+    # The sample level is copied to the temporary directory too, so its level cache isn't written into the
+    # source tree either
+    headless.set_up(state)
+    state["level_file"] = os.path.join(state["temp_dir"], os.path.basename(py_caster.LEVEL_FILE))
+    shutil.copy(py_caster.LEVEL_FILE, state["level_file"])
+
+def tearDownModule():
+    headless.tear_down(state)
+
+##############################################################
+# Tests
+##############################################################
+
+class GoldenImageTest(unittest.TestCase):
+    def setUp(self):
+        self.scene, self.spawn = load_scene()
+        self.parity_check = py_caster.PARITY_CHECK
+
+    def tearDown(self):
+        py_caster.PARITY_CHECK = self.parity_check
+
+    def assertMatchesGolden(self, name, surface):
+        # Frames that don't match are saved to the temporary directory of the system so they can be looked at
+        golden = frame_pixels(pygame.image.load(golden_name(name)))
+        frame = frame_pixels(surface)
+        self.assertEqual(golden.shape, frame.shape, "%s: frame is %s, golden image is %s" % (name, frame.shape, golden.shape))
+        bad = np.count_nonzero(np.abs(frame - golden).max(axis = 2) > PIXEL_TOLERANCE)
+        if bad > PIXEL_BUDGET * frame.shape[0] * frame.shape[1]:
+            failed_name = os.path.join(tempfile.gettempdir(), "pycaster-failed-%s.png" % name)
+            pygame.image.save(surface, failed_name)
+            self.fail("%s: %d pixels differ from the golden image, frame saved as %s" % (name, bad, failed_name))
+
+    def test_poses(self):
+        for entry in POSES:
+            self.assertMatchesGolden(entry[0], render_pose(self.scene, self.spawn, entry).frame_buffer)
+
+    def test_poses_from_texture_cache(self):
+        # The first pass fills the texture cache, the second one only loads from it
+        for entry in POSES:
+            render_pose(self.scene, self.spawn, entry)
+        scene, spawn = load_scene()
+        for entry in POSES:
+            self.assertMatchesGolden(entry[0], render_pose(scene, spawn, entry).frame_buffer)
+
+    def test_poses_from_truncated_level_cache(self):
+        # A level cache cut short is compiled again instead of being mapped
+        cache_name = state["level_file"] + py_caster.LEVEL_CACHE_SUFFIX
+        with open(cache_name, "rb") as f:
+            data = f.read()
+        with open(cache_name, "wb") as f:
+            f.write(data[:len(data) / 2])
+        scene, spawn = load_scene()
+        for entry in POSES:
+            self.assertMatchesGolden(entry[0], render_pose(scene, spawn, entry).frame_buffer)
+        self.assertEqual(os.path.getsize(cache_name), len(data))
+
+    def test_poses_from_level_cache_without_header(self):
+        # A level cache whose header is valid JSON but not an object is compiled again too
+        cache_name = state["level_file"] + py_caster.LEVEL_CACHE_SUFFIX
+        with open(cache_name, "wb") as f:
+            f.write(py_caster.LEVEL_CACHE_MAGIC + struct.pack("<I", 2) + "[]")
+        scene, spawn = load_scene()
+        for entry in POSES:
+            self.assertMatchesGolden(entry[0], render_pose(scene, spawn, entry).frame_buffer)
+
+    def test_poses_with_parity_check(self):
+        py_caster.PARITY_CHECK = True
+        for entry in POSES:
+            self.assertMatchesGolden(entry[0], render_pose(self.scene, self.spawn, entry).frame_buffer)
+
+    def test_rerender_is_stable(self):
+        # Rendering a pose again over its own frame leaves it unchanged
+        for entry in POSES:
+            renderer = render_pose(self.scene, self.spawn, entry)
+            renderer.invalidate()
+            self.assertMatchesGolden(entry[0], render_pose(self.scene, self.spawn, entry, renderer).frame_buffer)
+
+class FloorParityTest(unittest.TestCase):
+    def test_matches_per_pixel_path(self):
+        # Walls from next to the camera to past FAR, hit on both sides of the origin so the texture
+        # coordinates wrap both ways
+        scene, (position, direction, plane) = load_scene()
+        w, h_fb = py_caster.FB_SIZE
+        columns = np.arange(0, w, w / 16)
+        dists = np.linspace(1.05, 2.0 * py_caster.FAR, len(columns))
+        angles = np.linspace(0.0, 2.0 * math.pi, len(columns), endpoint = False)
+        points = np.zeros((w, 2))
+        proj_dists = np.ones(w)
+        heights = np.zeros(w, dtype = np.intp)
+        points[columns, 0] = position.x + (dists * np.cos(angles))
+        points[columns, 1] = position.y + (dists * np.sin(angles))
+        proj_dists[columns] = dists
+        heights[columns] = (h_fb / dists).astype(np.intp)
+
+        expected = pygame.Surface(py_caster.FB_SIZE, pygame.HWSURFACE)
+        per_pixel_floor(expected, scene, position, points, proj_dists, heights, columns)
+        frame = pygame.Surface(py_caster.FB_SIZE, pygame.HWSURFACE)
+        projection = py_caster.Projection(py_caster.FB_SIZE, py_caster.field_of_view(direction, plane))
+        scene.floor_caster.render(frame, projection, position, points, proj_dists, heights)
+
+        differ = np.nonzero((frame_pixels(frame) != frame_pixels(expected)).any(axis = 2))
+        self.assertEqual(len(differ[0]), 0, "%d floor and ceiling pixels differ, the first at %s" %
+                         (len(differ[0]), zip(*differ)[:1]))
+
+class RenderTimeTest(unittest.TestCase):
+    def test_render_times(self):
+        if SKIP_TIMING:
+            self.skipTest("PYCASTER_SKIP_TIMING is set")
+        baseline = load_baseline()
+        self.assertEqual(tuple(baseline["fb_size"]), py_caster.FB_SIZE, "The baseline was measured at another frame buffer size")
+
+        scene, spawn = load_scene()
+        slow = []
+        for entry in POSES:
+            expected = baseline["poses"][entry[0]]
+            measured, reference = time_pose(scene, spawn, entry)
+            if measured > expected * reference * TIMING_TOLERANCE:
+                slow.append("%s %.2f ms, %.2f times the calibration workload (baseline %.2f times)" %
+                            (entry[0], measured, measured / reference, expected))
+        self.assertEqual(slow, [], "Poses slower than their baseline: " + ", ".join(slow))
+
+if __name__ == "__main__":
+    if "--update" in sys.argv:
+        # Rewrites the golden images and the baseline render times from the current renderer
+        setUpModule()
+        try:
+            update_goldens()
+        finally:
+            tearDownModule()
+    else:
+        unittest.main()